@@ -0,0 +1,224 @@
+# ai_risk_evaluation.py
+"""
+D4b: Risk Model Comparison (cross-validated, with cost metrics)
+
+Runs every candidate pipeline over the same stratified folds in parallel and
+reports accuracy (AUC), calibration (Brier, ECE) and cost (fit time, per-row
+inference latency, serialized model size) side by side. Costs are measured
+afterwards, one model at a time, so models don't compete for the CPU.
+"""
+
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import brier_score_loss, roc_auc_score
+from sklearn.model_selection import StratifiedKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from ai_risk_scoring import load_data, build_model, model_features, FEATURES_NUM, FEATURES_CAT
+
+REPORT_PATH = Path("data/analytics/risk_model_comparison.csv")
+
+N_FOLDS = int(os.environ.get("EVAL_FOLDS", 5))
+N_JOBS = int(os.environ.get("EVAL_N_JOBS", -1))     # -1 = all cores
+CALIBRATION_BINS = 10
+COST_REPEATS = int(os.environ.get("EVAL_COST_REPEATS", 3))
+
+
+def candidate_pipelines(df):
+    """
+    Candidate models keyed by name. "baseline" is the production pipeline
+    from ai_risk_scoring.build_model; "baseline_text" adds the hashed TF-IDF
+    text branch.
+    """
+    baseline, _, _ = build_model(df, text_features=False)
+    baseline_text, _, _ = build_model(df, text_features=True)
+
+    def prep(scale=False, dense=False):
+        return ColumnTransformer(
+            transformers=[
+                ("num", StandardScaler() if scale else "passthrough", FEATURES_NUM),
+                ("cat", OneHotEncoder(handle_unknown="ignore", sparse_output=not dense), FEATURES_CAT),
+            ]
+        )
+
+    return {
+        "baseline": baseline,
+        "baseline_text": baseline_text,
+        "logreg_scaled": Pipeline(steps=[
+            ("prep", prep(scale=True)),
+            ("clf", LogisticRegression(max_iter=1000)),
+        ]),
+        "logreg_balanced": Pipeline(steps=[
+            ("prep", prep(scale=True)),
+            ("clf", LogisticRegression(max_iter=1000, class_weight="balanced")),
+        ]),
+        "random_forest": Pipeline(steps=[
+            ("prep", prep()),
+            ("clf", RandomForestClassifier(n_estimators=200, min_samples_leaf=5, random_state=42, n_jobs=1)),
+        ]),
+        "hist_gradient_boosting": Pipeline(steps=[
+            ("prep", prep(dense=True)),
+            ("clf", HistGradientBoostingClassifier(max_iter=200, random_state=42)),
+        ]),
+    }
+
+
+def expected_calibration_error(y_true, y_prob, n_bins=CALIBRATION_BINS):
+    bins = np.minimum((y_prob * n_bins).astype(int), n_bins - 1)
+    ece = 0.0
+    for b in range(n_bins):
+        mask = bins == b
+        if mask.any():
+            ece += mask.mean() * abs(y_prob[mask].mean() - y_true[mask].mean())
+    return ece
+
+
+def evaluate_fold(name, pipeline, X, y, train_idx, test_idx):
+    model = clone(pipeline)
+    X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
+    y_train, y_test = y.iloc[train_idx], y.iloc[test_idx]
+
+    model.fit(X_train, y_train)
+    y_prob = model.predict_proba(X_test)[:, 1]
+
+    return {
+        "model": name,
+        "auc": roc_auc_score(y_test, y_prob),
+        "brier": brier_score_loss(y_test, y_prob),
+        "ece": expected_calibration_error(y_test.to_numpy(), y_prob),
+    }
+
+
+def measure_cost(name, pipeline, X, y, train_idx, test_idx, repeats=COST_REPEATS):
+    """
+    Fit time, batch/single-row latency and size of one model on one fold.
+    Run serially: timings taken while other fits share the CPU aren't
+    comparable between models.
+    """
+    X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
+    y_train = y.iloc[train_idx]
+
+    fit_times = []
+    for _ in range(repeats):
+        model = clone(pipeline)
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_times.append(time.perf_counter() - start)
+
+    # Batch latency (amortized per row) and single-record latency
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict_proba(X_test)
+    batch_ms_per_row = (time.perf_counter() - start) * 1000 / (repeats * len(X_test))
+
+    row = X_test.iloc[[0]]
+    start = time.perf_counter()
+    for _ in range(20):
+        model.predict_proba(row)
+    single_row_ms = (time.perf_counter() - start) * 1000 / 20
+
+    return {
+        "model": name,
+        "fit_seconds": float(np.median(fit_times)),
+        "batch_ms_per_row": batch_ms_per_row,
+        "single_row_ms": single_row_ms,
+        "model_kb": len(pickle.dumps(model)) / 1024,
+    }
+
+
+def benchmark_text_branch(df, repeats=3):
+    """
+    Fit/score throughput of the dense baseline vs the sparse text branch,
+    plus the size of the feature matrix each one produces.
+    """
+    rows = []
+    y = df["risk_label"]
+
+    for name, text_features in [("baseline", False), ("baseline_text", True)]:
+        model, X, _ = build_model(df, text_features=text_features)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model.fit(X, y)
+        fit_seconds = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model.predict_proba(X)
+        score_seconds = (time.perf_counter() - start) / repeats
+
+        Xt = model.named_steps["prep"].transform(X)
+        if hasattr(Xt, "nnz"):
+            matrix_kb = (Xt.data.nbytes + Xt.indices.nbytes + Xt.indptr.nbytes) / 1024
+        else:
+            matrix_kb = Xt.nbytes / 1024
+
+        rows.append({
+            "model": name,
+            "n_features": Xt.shape[1],
+            "sparse": hasattr(Xt, "nnz"),
+            "matrix_kb": round(matrix_kb, 1),
+            "fit_rows_per_s": round(len(X) / fit_seconds),
+            "score_rows_per_s": round(len(X) / score_seconds),
+        })
+
+    return pd.DataFrame(rows).set_index("model")
+
+
+def compare_models(df):
+    X = df[model_features(text_features=True)]
+    y = df["risk_label"]
+
+    folds = list(StratifiedKFold(n_splits=N_FOLDS, shuffle=True, random_state=42).split(X, y))
+    candidates = candidate_pipelines(df)
+
+    results = Parallel(n_jobs=N_JOBS)(
+        delayed(evaluate_fold)(name, pipeline, X, y, train_idx, test_idx)
+        for name, pipeline in candidates.items()
+        for train_idx, test_idx in folds
+    )
+
+    per_fold = pd.DataFrame(results)
+    report = per_fold.groupby("model").agg(
+        auc_mean=("auc", "mean"),
+        auc_std=("auc", "std"),
+        brier=("brier", "mean"),
+        ece=("ece", "mean"),
+    )
+
+    train_idx, test_idx = folds[0]
+    costs = pd.DataFrame([
+        measure_cost(name, pipeline, X, y, train_idx, test_idx)
+        for name, pipeline in candidates.items()
+    ]).set_index("model")
+    report = report.join(costs)
+    return report.sort_values("auc_mean", ascending=False).round(4)
+
+
+def main():
+    df = load_data()
+    report = compare_models(df)
+
+    report.to_csv(REPORT_PATH)
+
+    print(f"✅ Model comparison completed ({N_FOLDS}-fold CV)")
+    print(f"Report saved to: {REPORT_PATH}\n")
+    print(report.to_string())
+
+    print("\nText branch throughput (full table):\n")
+    print(benchmark_text_branch(df).to_string())
+
+
+if __name__ == "__main__":
+    main()
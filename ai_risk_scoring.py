@@ -3,16 +3,56 @@
 D4: Risk Scoring / Severity Prediction (Offline, Explainable)
 """
 
+import os
+import re
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import joblib
+import numpy as np
 import pandas as pd
+import sklearn
 from pathlib import Path
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.linear_model import LogisticRegression
+from scipy import sparse
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.preprocessing import OneHotEncoder, StandardScaler, FunctionTransformer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import train_test_split
+from sklearn.metrics import brier_score_loss, roc_auc_score
+
+import column_store
 
 DATA_PATH = Path("data/analytics/defect_reports_with_clusters.csv")
 OUT_PATH = Path("data/analytics/defect_reports_with_risk.csv")
+MODEL_DIR = Path("data/analytics/models")
+
+# train       -> fit, save a new model version and score the table
+# incremental -> stream the archive in chunks through an SGD model (out-of-core)
+# score       -> score the table with the latest saved model (no retraining)
+RISK_MODE = os.environ.get("RISK_MODE", "train")
+
+# Incremental (out-of-core) training settings
+ARCHIVE_PATH = Path(os.environ.get("RISK_ARCHIVE_PATH", DATA_PATH))
+CHUNK_SIZE = int(os.environ.get("RISK_CHUNK_SIZE", 50_000))
+EPOCHS = int(os.environ.get("RISK_EPOCHS", 5))
+HASH_FEATURES = 2 ** 12
+
+# Optional sparse text branch (hashed TF-IDF over the free-text fields)
+TEXT_FEATURES = os.environ.get("RISK_TEXT_FEATURES", "0") == "1"
+TEXT_HASH_FEATURES = 2 ** 18
+
+# Store the top contributing features next to risk_level for every record
+EXPLAIN = os.environ.get("RISK_EXPLAIN", "1") == "1"
+EXPLAIN_TOP_N = 3
+
+FEATURES_NUM = ["life_hours", "defect_len", "root_cause_cluster"]
+FEATURES_CAT = ["system"]
+FEATURES_TEXT = ["defect_observed", "root_cause", "findings"]
+HIGH_RISK_CATEGORIES = ["mission critical", "critical"]
 
 
 def load_data():
@@ -22,27 +62,65 @@ def load_data():
     df["life_hours"] = pd.to_numeric(df["life_hours"], errors="coerce").fillna(df["life_hours"].median())
     df["defect_len"] = df["defect_observed"].astype(str).str.len()
 
+    df["risk_label"] = make_risk_label(df["defect_category"])
+
+    return df
+
+
+def make_risk_label(categories):
     # Target label (heuristic, explainable)
     # Mission Critical / Critical → High risk
-    df["risk_label"] = df["defect_category"].apply(
-        lambda x: 1 if str(x).lower() in ["mission critical", "critical"] else 0
-    )
+    return categories.astype(str).str.lower().isin(HIGH_RISK_CATEGORIES).astype(int)
 
-    return df
+
+def join_text(X):
+    # One document per row from the free-text columns
+    return X.fillna("").astype(str).agg(" ".join, axis=1)
 
 
-def build_model(df):
-    features_num = ["life_hours", "defect_len", "root_cause_cluster"]
-    features_cat = ["system"]
+def text_branch():
+    """
+    Hashed TF-IDF: fixed-width sparse output, no vocabulary kept in memory.
+    Only the idf weights (one float per hash bucket) are learned.
+    """
+    return Pipeline(steps=[
+        ("join", FunctionTransformer(join_text)),
+        ("hash", HashingVectorizer(
+            n_features=TEXT_HASH_FEATURES,
+            stop_words="english",
+            alternate_sign=False,
+            norm=None,
+        )),
+        ("tfidf", TfidfTransformer()),
+    ])
 
-    X = df[features_num + features_cat]
+
+def model_features(text_features=TEXT_FEATURES):
+    features = FEATURES_NUM + FEATURES_CAT
+    if text_features:
+        features = features + FEATURES_TEXT
+    return features
+
+
+def build_model(df, text_features=TEXT_FEATURES):
+    features_num = FEATURES_NUM
+    features_cat = FEATURES_CAT
+
+    X = df[model_features(text_features)]
     y = df["risk_label"]
 
+    transformers = [
+        # Raw numerics swamp the unit-norm TF-IDF columns, so scale them when text is on
+        ("num", StandardScaler() if text_features else "passthrough", features_num),
+        ("cat", OneHotEncoder(handle_unknown="ignore"), features_cat),
+    ]
+    if text_features:
+        transformers.append(("text", text_branch(), FEATURES_TEXT))
+
     preprocessor = ColumnTransformer(
-        transformers=[
-            ("num", "passthrough", features_num),
-            ("cat", OneHotEncoder(handle_unknown="ignore"), features_cat),
-        ]
+        transformers=transformers,
+        # Keep the output sparse whenever the text branch is present
+        sparse_threshold=1.0 if text_features else 0.3,
     )
 
     model = Pipeline(
@@ -55,38 +133,461 @@ def build_model(df):
     return model, X, y
 
 
+# -------------------------------------------------
+# INCREMENTAL (OUT-OF-CORE) TRAINING
+# -------------------------------------------------
+def hashed_features(X, num_mean, num_scale):
+    """
+    Stateless preprocessing for the incremental model: standardize numerics
+    with frozen running statistics and hash categoricals into a fixed-width
+    sparse space (no vocabulary to hold in memory).
+    """
+    num = (X[FEATURES_NUM].to_numpy(dtype=float) - num_mean) / num_scale
+
+    hasher = FeatureHasher(n_features=HASH_FEATURES, input_type="string")
+    cat = hasher.transform(
+        [f"{col}={val}" for col, val in zip(FEATURES_CAT, row)]
+        for row in X[FEATURES_CAT].astype(str).itertuples(index=False)
+    )
+
+    return sparse.hstack([sparse.csr_matrix(num), cat], format="csr")
+
+
+def read_archive_chunks():
+    # root_cause lets prepare_features cluster rows that arrive without a cluster
+    usecols = ["life_hours", "defect_observed", "root_cause", "root_cause_cluster", "system",
+               "defect_category"]
+    return pd.read_csv(ARCHIVE_PATH, usecols=usecols, chunksize=CHUNK_SIZE)
+
+
+def train_incremental():
+    """
+    Train a logistic model on the archive without loading it into memory.
+    Pass 1 accumulates running mean/variance per numeric feature (also used
+    to impute life_hours); later passes stream chunks through partial_fit.
+    Returns (pipeline, life_hours_fill, n_rows, baseline) where baseline is
+    the mean transformed row, accumulated during the first epoch.
+    """
+    start = time.perf_counter()
+    scaler = StandardScaler()
+    n_rows = 0
+
+    for chunk in read_archive_chunks():
+        chunk["life_hours"] = pd.to_numeric(chunk["life_hours"], errors="coerce")
+        chunk["defect_len"] = chunk["defect_observed"].astype(str).str.len()
+        scaler.partial_fit(chunk[FEATURES_NUM])   # NaNs are ignored
+        n_rows += len(chunk)
+
+    elapsed = time.perf_counter() - start
+    print(f"Stats pass: {n_rows:,} rows in {elapsed:.2f}s ({n_rows / elapsed:,.0f} rows/s)")
+
+    life_hours_fill = float(scaler.mean_[FEATURES_NUM.index("life_hours")])
+    prep = FunctionTransformer(
+        hashed_features,
+        kw_args={"num_mean": scaler.mean_, "num_scale": scaler.scale_},
+    )
+    # Averaged SGD with stronger regularization keeps probabilities from
+    # saturating at 0/1 on small or skewed archives
+    clf = SGDClassifier(loss="log_loss", alpha=1e-3, average=True, random_state=42)
+
+    column_sum = None
+
+    for epoch in range(EPOCHS):
+        start = time.perf_counter()
+
+        for chunk in read_archive_chunks():
+            chunk = chunk.sample(frac=1, random_state=epoch)
+            X = prep.transform(prepare_features(chunk, life_hours_fill))
+            clf.partial_fit(X, make_risk_label(chunk["defect_category"]), classes=[0, 1])
+            if epoch == 0:
+                chunk_sum = np.asarray(X.sum(axis=0)).ravel()
+                column_sum = chunk_sum if column_sum is None else column_sum + chunk_sum
+
+        elapsed = time.perf_counter() - start
+        print(f"Epoch {epoch + 1}/{EPOCHS}: {n_rows / elapsed:,.0f} rows/s")
+
+    pipeline = Pipeline(steps=[("prep", prep), ("clf", clf)])
+    return pipeline, life_hours_fill, n_rows, column_sum / max(n_rows, 1)
+
+
+# -------------------------------------------------
+# SCORING
+# -------------------------------------------------
+def risk_level(score):
+    if score >= 0.7:
+        return "High"
+    elif score >= 0.4:
+        return "Medium"
+    else:
+        return "Low"
+
+
+def risk_levels(scores):
+    # Vectorized form of risk_level for batches
+    scores = np.asarray(scores)
+    return np.select([scores >= 0.7, scores >= 0.4], ["High", "Medium"], default="Low")
+
+
+def prepare_features(df, life_hours_fill, features=None):
+    """
+    Derive model features for new records using statistics frozen at training
+    time, so a single record scores the same as it would inside a full batch.
+    """
+    df = df.copy()
+
+    if "life_hours" not in df.columns:
+        df["life_hours"] = np.nan
+    df["life_hours"] = pd.to_numeric(df["life_hours"], errors="coerce").fillna(life_hours_fill)
+
+    if "defect_len" not in df.columns:
+        df["defect_len"] = df["defect_observed"].astype(str).str.len()
+
+    if "root_cause_cluster" not in df.columns or df["root_cause_cluster"].isna().any():
+        from ai_root_cause_clustering import predict_clusters
+
+        missing = df.get("root_cause_cluster", pd.Series(np.nan, index=df.index)).isna()
+        df.loc[missing, "root_cause_cluster"] = predict_clusters(
+            df.loc[missing, "root_cause"], df.loc[missing, "defect_observed"]
+        )
+        df["root_cause_cluster"] = df["root_cause_cluster"].astype(int)
+
+    features = features or FEATURES_NUM + FEATURES_CAT
+    for col in features:
+        if col in FEATURES_TEXT and col not in df.columns:
+            df[col] = ""
+
+    return df[features]
+
+
+def score_records(records, artifact=None):
+    """
+    Score one record (dict), many records (list of dicts) or a DataFrame
+    with the saved model. Returns the same shape with risk_score and
+    risk_level added.
+    """
+    if artifact is None:
+        artifact = load_model()
+    check_clustering(artifact)
+
+    single = isinstance(records, dict)
+    df = pd.DataFrame([records] if single else records)
+
+    X = prepare_features(df, artifact["life_hours_fill"], artifact["features"])
+    scores = artifact["pipeline"].predict_proba(X)[:, 1]
+
+    df["risk_score"] = scores
+    df["risk_level"] = risk_levels(scores)
+
+    if single:
+        return df.iloc[0].to_dict()
+    if isinstance(records, pd.DataFrame):
+        return df
+    return df.to_dict(orient="records")
+
+
+def check_clustering(artifact):
+    """
+    root_cause_cluster numbers only mean what the model learned under the
+    clustering it was trained with; refuse to score after a re-cluster.
+    """
+    expected = artifact.get("clustering_version")
+    if expected is None:
+        return                      # saved before the clustering was recorded
+
+    from ai_root_cause_clustering import clustering_version
+
+    current = clustering_version()
+    if current is not None and current != expected:
+        raise ValueError(
+            f"Risk model v{artifact['version']} was trained on clustering {expected}, "
+            f"but the saved clustering model is {current}; retrain it with ai_risk_scoring.py"
+        )
+
+
+def score_stream(records, batch_size=256, artifact=None):
+    """
+    Score an iterable of incoming records as they arrive, in small batches.
+    Yields scored records one at a time.
+    """
+    if artifact is None:
+        artifact = load_model()
+
+    batch = []
+    for rec in records:
+        batch.append(rec)
+        if len(batch) >= batch_size:
+            yield from score_records(batch, artifact)
+            batch = []
+
+    if batch:
+        yield from score_records(batch, artifact)
+
+
+# -------------------------------------------------
+# BULK EXPLANATIONS
+# -------------------------------------------------
+def feature_groups(prep, n_columns):
+    """
+    Map each transformed column to a human-readable feature group.
+    Numerics keep their own name, the one-hot levels of a categorical
+    column form one group per column, and a hashed branch collapses to one
+    group since individual buckets mean nothing.
+    Returns (group_index_per_column, group_names).
+    """
+    names, index = [], np.empty(n_columns, dtype=int)
+
+    def add_group(name, columns):
+        index[columns] = len(names)
+        names.append(name)
+
+    if isinstance(prep, ColumnTransformer):
+        for name, trans, cols in prep.transformers_:
+            if name not in prep.output_indices_:
+                continue
+            out = prep.output_indices_[name]
+            if name == "cat":
+                # All levels of a column form one group; only the record's
+                # own level is non-zero, so the group is named after it
+                start = out.start
+                for col, levels in zip(cols, trans.categories_):
+                    add_group(col, slice(start, start + len(levels)))
+                    start += len(levels)
+            elif name == "num":
+                for i, col in enumerate(cols):
+                    add_group(col, out.start + i)
+            elif out.stop > out.start:
+                add_group(name, slice(out.start, out.stop))
+    else:
+        # Incremental model: scaled numerics followed by hashed categoricals
+        for i, col in enumerate(FEATURES_NUM):
+            add_group(col, i)
+        add_group("+".join(FEATURES_CAT), slice(len(FEATURES_NUM), n_columns))
+
+    return index, names
+
+
+def explain_records(df, artifact=None, top_n=EXPLAIN_TOP_N):
+    """
+    Per-record contribution of every feature group to the risk logit,
+    computed for the whole table at once from the linear model's
+    coefficients. Contributions are relative to the mean training row saved
+    in the artifact, so they sum to (record logit - baseline logit) and a
+    record gets the same drivers however it is batched. A categorical
+    driver is reported under the record's own level (system=X).
+    Returns a DataFrame with a risk_drivers summary per row.
+    """
+    if artifact is None:
+        artifact = load_model()
+
+    pipeline = artifact["pipeline"]
+    prep, clf = pipeline.named_steps["prep"], pipeline.named_steps["clf"]
+    if not hasattr(clf, "coef_"):
+        raise ValueError("Bulk explanations need a linear model with coef_")
+
+    X = prepare_features(df, artifact["life_hours_fill"], artifact["features"])
+    Xt = sparse.csr_matrix(prep.transform(X))
+
+    group_index, group_names = feature_groups(prep, Xt.shape[1])
+
+    # Coefficient-weighted column -> group indicator, then one sparse product
+    W = sparse.csr_matrix(
+        (clf.coef_[0], (np.arange(Xt.shape[1]), group_index)),
+        shape=(Xt.shape[1], len(group_names)),
+    )
+    grouped = np.asarray((Xt @ W).todense())
+    baseline = artifact.get("baseline")
+    if baseline is None:
+        # Artifacts saved before baselines: fall back to the batch average
+        contrib = grouped - grouped.mean(axis=0)
+    else:
+        contrib = grouped - np.asarray(W.T @ baseline).ravel()
+
+    top_n = min(top_n, len(group_names))
+    top = np.argpartition(-np.abs(contrib), top_n - 1, axis=1)[:, :top_n]
+    order = np.take_along_axis(-np.abs(contrib), top, axis=1).argsort(axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_vals = np.take_along_axis(contrib, top, axis=1)
+
+    levels = {col: X[col].astype(str).to_numpy() for col in FEATURES_CAT if col in X.columns}
+    drivers = [
+        "; ".join(
+            f"{group_names[g]}={levels[group_names[g]][i]} ({v:+.2f})" if group_names[g] in levels
+            else f"{group_names[g]} ({v:+.2f})"
+            for g, v in zip(row_groups, row_vals)
+        )
+        for i, (row_groups, row_vals) in enumerate(zip(top, top_vals))
+    ]
+
+    return pd.DataFrame(
+        {"risk_drivers": drivers},
+        index=df.index,
+    )
+
+
+def training_baseline(prep, X):
+    """
+    Mean transformed training row: the reference point explanations are
+    measured from.
+    """
+    return np.asarray(prep.transform(X).mean(axis=0)).ravel()
+
+
+# -------------------------------------------------
+# MODEL ARTIFACTS
+# -------------------------------------------------
+def model_versions():
+    versions = []
+    for p in MODEL_DIR.glob("risk_model_v*.joblib"):
+        m = re.match(r"risk_model_v(\d+)\.joblib$", p.name)
+        if m:
+            versions.append(int(m.group(1)))
+    return sorted(versions)
+
+
+def save_model(pipeline, life_hours_fill, n_train_rows, trainer="batch", features=None,
+               baseline=None):
+    from ai_root_cause_clustering import clustering_version
+
+    MODEL_DIR.mkdir(parents=True, exist_ok=True)
+
+    versions = model_versions()
+    version = (versions[-1] + 1) if versions else 1
+    path = MODEL_DIR / f"risk_model_v{version}.joblib"
+
+    joblib.dump({
+        "version": version,
+        "trained_at": datetime.now().isoformat(),
+        "sklearn_version": sklearn.__version__,
+        "trainer": trainer,
+        "features": features or FEATURES_NUM + FEATURES_CAT,
+        "life_hours_fill": life_hours_fill,
+        "n_train_rows": n_train_rows,
+        "baseline": baseline,
+        # Which clustering produced the root_cause_cluster labels
+        "clustering_version": clustering_version(),
+        "pipeline": pipeline,
+    }, path)
+
+    return path
+
+
+@lru_cache(maxsize=4)
+def load_model(version=None):
+    """
+    Load a saved model artifact (latest version by default).
+    Cached per process so repeated scoring calls don't hit disk.
+    """
+    if version is None:
+        versions = model_versions()
+        if not versions:
+            raise FileNotFoundError(
+                f"No risk model found in {MODEL_DIR} (run ai_risk_scoring.py to train one)"
+            )
+        version = versions[-1]
+
+    return migrate_artifact(joblib.load(MODEL_DIR / f"risk_model_v{version}.joblib"))
+
+
+def migrate_artifact(artifact):
+    """
+    Fill in keys that older artifact versions saved under another name or
+    not at all, so every saved version still scores.
+    """
+    if "life_hours_fill" not in artifact:
+        artifact["life_hours_fill"] = artifact["life_hours_median"]
+    artifact.setdefault("features", FEATURES_NUM + FEATURES_CAT)
+    artifact.setdefault("trainer", "batch")
+    artifact.setdefault("clustering_version", None)
+    return artifact
+
+
+def score_in_chunks(artifact):
+    """
+    Out-of-core counterpart of main's in-memory scoring: stream DATA_PATH
+    through the model CHUNK_SIZE rows at a time and append to OUT_PATH.
+    Returns the risk level distribution.
+    """
+    tmp = OUT_PATH.with_name(OUT_PATH.name + ".tmp")
+    counts = pd.Series(dtype=int)
+
+    for i, chunk in enumerate(pd.read_csv(DATA_PATH, chunksize=CHUNK_SIZE)):
+        chunk["defect_len"] = chunk["defect_observed"].astype(str).str.len()
+        chunk["risk_label"] = make_risk_label(chunk["defect_category"])
+        chunk = score_records(chunk, artifact)
+        if EXPLAIN:
+            chunk["risk_drivers"] = explain_records(chunk, artifact)["risk_drivers"]
+
+        chunk.to_csv(tmp, mode="w" if i == 0 else "a", header=i == 0, index=False)
+        counts = counts.add(chunk["risk_level"].value_counts(), fill_value=0)
+
+    os.replace(tmp, OUT_PATH)
+    return counts.astype(int)
+
+
 def main():
+    if RISK_MODE == "incremental":
+        pipeline, life_hours_fill, n_rows, baseline = train_incremental()
+        model_path = save_model(pipeline, life_hours_fill, n_rows, trainer="incremental",
+                                baseline=baseline)
+        load_model.cache_clear()
+        print(f"Model saved to: {model_path}")
+
+        # Stay out-of-core: no full-table load after streaming training
+        counts = score_in_chunks(load_model())
+        print("✅ Risk scoring completed")
+        print(f"Output saved to: {OUT_PATH}")
+        print("Dashboard columns are rebuilt from it on the next dashboard start.")
+        print("\nRisk Level Distribution:")
+        print(counts)
+        return
+
     df = load_data()
-    model, X, y = build_model(df)
 
-    # Train (offline, historical)
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, random_state=42
-    )
+    if RISK_MODE == "score":
+        artifact = load_model()
+        print(f"Using saved risk model v{artifact['version']}")
+    else:
+        model, X, y = build_model(df)
+
+        # Train (offline, historical)
+        X_train, X_test, y_train, y_test = train_test_split(
+            X, y, test_size=0.2, random_state=42
+        )
+
+        model.fit(X_train, y_train)
 
-    model.fit(X_train, y_train)
+        # Held-out check
+        test_prob = model.predict_proba(X_test)[:, 1]
+        print(f"Held-out AUC: {roc_auc_score(y_test, test_prob):.3f} | "
+              f"Brier: {brier_score_loss(y_test, test_prob):.3f}")
 
-    # Predict risk probability
-    df["risk_score"] = model.predict_proba(X)[:, 1]
+        model_path = save_model(
+            model, float(df["life_hours"].median()), len(df), features=list(X.columns),
+            baseline=training_baseline(model.named_steps["prep"], X_train),
+        )
+        load_model.cache_clear()
+        artifact = load_model()
+        print(f"Model saved to: {model_path}")
 
-    # Convert to human-readable level
-    def risk_level(score):
-        if score >= 0.7:
-            return "High"
-        elif score >= 0.4:
-            return "Medium"
-        else:
-            return "Low"
+    # Predict risk probability and convert to human-readable level
+    df = score_records(df, artifact)
 
-    df["risk_level"] = df["risk_score"].apply(risk_level)
+    if EXPLAIN:
+        df["risk_drivers"] = explain_records(df, artifact)["risk_drivers"]
 
     df.to_csv(OUT_PATH, index=False)
+    # Typed, per-column copy for the dashboard (month precomputed there)
+    column_meta = column_store.write_columns(df)
 
     print("✅ Risk scoring completed")
     print(f"Output saved to: {OUT_PATH}")
+    print(f"Dashboard columns saved in: {column_store.COLUMN_DIR} (v{column_meta['version']})")
     print("\nRisk Level Distribution:")
     print(df["risk_level"].value_counts())
 
 
 if __name__ == "__main__":
-    main()
+    # Run via the importable module so pickled helpers (join_text,
+    # hashed_features) resolve as ai_risk_scoring.* when the model is loaded
+    import ai_risk_scoring
+    ai_risk_scoring.main()
@@ -3,15 +3,55 @@
 D3: Root Cause Clustering (Unsupervised AI)
 """
 
+import hashlib
+import os
+import time
+from functools import lru_cache
+
+import joblib
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from joblib import Parallel, delayed
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+
+import embedding_store
 
 DATA_PATH = "data/analytics/defect_reports_with_clusters.csv"
 OUT_PATH = Path("data/analytics/defect_reports_with_clusters.csv")
+MODEL_PATH = Path("data/analytics/root_cause_clustering.joblib")
+SWEEP_REPORT_PATH = Path("data/analytics/cluster_sweep_report.csv")
+
+# Text features to cluster on:
+#   tfidf      -> TF-IDF over root_cause only (original behaviour)
+#   embeddings -> cached sentence embeddings of defect_observed + root_cause
+#                 (built by ai_similarity_search.py, read via memory map)
+CLUSTER_FEATURES = os.environ.get("CLUSTER_FEATURES", "tfidf")
 
-NUM_CLUSTERS = 6   # you can tune this (5–8 recommended)
+NUM_CLUSTERS = 6   # default when not sweeping (CLUSTER_MODE=sweep picks k automatically)
+
+# Curated names for the default configuration (TF-IDF, NUM_CLUSTERS clusters);
+# any other k or feature set gets names derived from the clusters themselves
+ROOT_CAUSE_CLUSTER_MAP = {
+    0: "Environmental / EMI & Moisture",
+    1: "Maintenance / Calibration / Installation",
+    2: "Environmental Aging / Material Degradation",
+    3: "Mechanical / Vibration / Fasteners",
+    4: "Manufacturing / Material Defect",
+    5: "Design / Operational Limit Exceedance"
+}
+
+# Sweep settings (override via environment)
+CLUSTER_MODE = os.environ.get("CLUSTER_MODE", "fixed")          # fixed | sweep
+SWEEP_K_MIN = int(os.environ.get("SWEEP_K_MIN", 4))
+SWEEP_K_MAX = int(os.environ.get("SWEEP_K_MAX", 10))
+# 0 -> one job per k, up to the core count; joblib's loky workers cap each
+# job's OpenMP/BLAS threads to their share of the cores
+SWEEP_N_JOBS = int(os.environ.get("SWEEP_N_JOBS", 0))
+CLUSTER_NAME_TERMS = 3
+SILHOUETTE_SAMPLE = int(os.environ.get("SILHOUETTE_SAMPLE", 2000))
 
 
 def load_data():
@@ -32,9 +72,9 @@ def vectorize_text(text_series):
     return X, vectorizer
 
 
-def cluster_text(X):
+def cluster_text(X, n_clusters=NUM_CLUSTERS):
     model = KMeans(
-        n_clusters=NUM_CLUSTERS,
+        n_clusters=n_clusters,
         random_state=42,
         n_init=10
     )
@@ -42,11 +82,191 @@ def cluster_text(X):
     return labels, model
 
 
+def load_embedding_features(df):
+    """
+    Map the shared embedding store instead of re-featurizing text.
+    Rows are matched to the CSV by case_id (the store's own order is kept
+    when it already lines up, so no copy is made).
+    """
+    X, manifest = embedding_store.load_store()
+    case_ids = df["case_id"].astype(str)
+    store_ids = manifest["case_ids"]
+
+    if case_ids.tolist() == store_ids:
+        return X
+
+    position = pd.Series(np.arange(len(store_ids)), index=store_ids)
+    missing = ~case_ids.isin(position.index)
+    if missing.any() or not case_ids.is_unique or not position.index.is_unique:
+        raise ValueError(
+            f"Embedding store does not match the records in {DATA_PATH} ({int(missing.sum())} "
+            "case_ids missing, or duplicated); rebuild embeddings with ai_similarity_search.py"
+        )
+    return np.asarray(X[position.loc[case_ids].to_numpy()])
+
+
+def evaluate_k(X, k):
+    """
+    Fit one KMeans configuration and score it.
+    Silhouette is computed on a fixed-size sample so cost stays flat on large data.
+    """
+    start = time.perf_counter()
+    labels, model = cluster_text(X, n_clusters=k)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sample_size = min(SILHOUETTE_SAMPLE, X.shape[0])
+    silhouette = silhouette_score(X, labels, sample_size=sample_size, random_state=42)
+    score_seconds = time.perf_counter() - start
+
+    return {
+        "k": k,
+        "silhouette": round(float(silhouette), 4),
+        "inertia": round(float(model.inertia_), 4),
+        "fit_seconds": round(fit_seconds, 3),
+        "score_seconds": round(score_seconds, 3),
+        "model": model,
+        "labels": labels,
+    }
+
+
+def sweep_clusters(X, k_values):
+    """
+    Evaluate a range of k values in parallel and return (best_result, report_df).
+    The best configuration is the one with the highest sampled silhouette.
+    """
+    k_values = list(k_values)
+    n_jobs = SWEEP_N_JOBS or min(len(k_values), os.cpu_count() or 1)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(evaluate_k)(X, k) for k in k_values
+    )
+
+    best = max(results, key=lambda r: r["silhouette"])
+
+    report = pd.DataFrame([
+        {key: val for key, val in r.items() if key not in ("model", "labels")}
+        for r in results
+    ])
+    report["selected"] = report["k"] == best["k"]
+    report.to_csv(SWEEP_REPORT_PATH, index=False)
+
+    return best, report
+
+
+def cluster_names(texts, labels, top_n=CLUSTER_NAME_TERMS):
+    """
+    Name each cluster after its members' top TF-IDF terms, so names follow
+    the cluster contents whatever k or label order KMeans produced.
+    """
+    X, vectorizer = vectorize_text(texts)
+    terms = vectorizer.get_feature_names_out()
+    labels = np.asarray(labels)
+
+    names = {}
+    for label in np.unique(labels):
+        centroid = np.asarray(X[labels == label].mean(axis=0)).ravel()
+        top = [j for j in centroid.argsort()[::-1][:top_n] if centroid[j] > 0]
+        names[int(label)] = " / ".join(terms[j].title() for j in top) or f"Cluster {label}"
+    return names
+
+
+def is_curated(model, vectorizer):
+    return vectorizer is not None and model.n_clusters == NUM_CLUSTERS
+
+
+def save_model(model, vectorizer, names, embedding_model=None):
+    joblib.dump({
+        "model": model,
+        "vectorizer": vectorizer,
+        "names": names,
+        # Sentence model behind the features when fit on embeddings
+        "embedding_model": embedding_model,
+    }, MODEL_PATH)
+    load_model.cache_clear()
+    clustering_version.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def load_model():
+    return joblib.load(MODEL_PATH)
+
+
+@lru_cache(maxsize=1)
+def clustering_version():
+    """
+    Digest of the saved clustering model. Re-clustering can renumber the
+    labels, so models trained on root_cause_cluster record this and check
+    it before scoring. None when there is no model yet.
+    """
+    if not MODEL_PATH.exists():
+        return None
+    artifact = load_model()
+    digest = hashlib.sha1(np.ascontiguousarray(artifact["model"].cluster_centers_).tobytes())
+    if artifact.get("vectorizer") is not None:
+        digest.update(",".join(artifact["vectorizer"].get_feature_names_out()).encode("utf-8"))
+    else:
+        digest.update(str(artifact.get("embedding_model")).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def load_cluster_names():
+    """
+    {cluster: name} for the saved clustering model: the curated names for
+    the default configuration, otherwise the names saved with it. Empty
+    when there is no model yet or it predates saved names.
+    """
+    if not MODEL_PATH.exists():
+        return {}
+    artifact = load_model()
+    if is_curated(artifact["model"], artifact.get("vectorizer")):
+        return dict(ROOT_CAUSE_CLUSTER_MAP)
+    return artifact.get("names", {})
+
+
+@lru_cache(maxsize=1)
+def load_text_encoder(model_name):
+    # Reference model: the store vectors the clusters were fit on came from it
+    import encoder
+    return encoder.load_encoder(model_name, backend="torch")
+
+
+def predict_clusters(root_causes, defect_observed=None):
+    """
+    Assign clusters to new root cause texts with the saved clustering artifact.
+    A model fit on embeddings embeds defect_observed + root_cause the way
+    the embedding store does and assigns the nearest centroid.
+    """
+    artifact = load_model()
+    root_causes = pd.Series(root_causes).reset_index(drop=True)
+
+    if artifact["vectorizer"] is not None:
+        texts = root_causes.fillna("Not specified")
+        return artifact["model"].predict(artifact["vectorizer"].transform(texts))
+
+    if defect_observed is None:
+        defect_observed = pd.Series("", index=root_causes.index)
+    defect_observed = pd.Series(defect_observed).reset_index(drop=True)
+    texts = defect_observed.fillna("") + " " + root_causes.fillna("")
+
+    # Artifacts saved before the model name was recorded were fit on the current store
+    model_name = artifact.get("embedding_model") or embedding_store.load_manifest()["model_name"]
+    X = load_text_encoder(model_name).encode(texts.tolist(), normalize_embeddings=True)
+    return artifact["model"].predict(np.asarray(X, dtype=np.float32))
+
+
+def print_cluster_examples(df, labels):
+    # Embedding clusters have no vocabulary; show the most common root cause instead
+    print("\n🔹 Root Cause Clusters & Most Common Root Cause:\n")
+    common = df.groupby(labels)["root_cause_clean"].agg(lambda s: s.value_counts().index[0])
+    for i, text in common.items():
+        print(f"Cluster {i}: {text}")
+
+
 def print_cluster_keywords(model, vectorizer):
     terms = vectorizer.get_feature_names_out()
 
     print("\n🔹 Root Cause Clusters & Top Keywords:\n")
-    for i in range(NUM_CLUSTERS):
+    for i in range(model.n_clusters):
         top_indices = model.cluster_centers_[i].argsort()[-10:][::-1]
         keywords = [terms[j] for j in top_indices]
         print(f"Cluster {i}: {', '.join(keywords)}")
@@ -54,16 +274,47 @@ def print_cluster_keywords(model, vectorizer):
 
 def main():
     df = load_data()
-    X, vectorizer = vectorize_text(df["root_cause_clean"])
-    labels, model = cluster_text(X)
+
+    embedding_model = None
+    if CLUSTER_FEATURES == "embeddings":
+        X, vectorizer = load_embedding_features(df), None
+        embedding_model = embedding_store.load_manifest()["model_name"]
+    else:
+        X, vectorizer = vectorize_text(df["root_cause_clean"])
+
+    if CLUSTER_MODE == "sweep":
+        k_values = range(SWEEP_K_MIN, SWEEP_K_MAX + 1)
+        best, report = sweep_clusters(X, k_values)
+        labels, model = best["labels"], best["model"]
+
+        print("\n🔹 Cluster Count Sweep:\n")
+        print(report.to_string(index=False))
+        print(f"\nSelected k = {best['k']} (silhouette {best['silhouette']})")
+        print(f"Sweep report saved to: {SWEEP_REPORT_PATH}")
+    else:
+        labels, model = cluster_text(X)
 
     df["root_cause_cluster"] = labels
+    if is_curated(model, vectorizer):
+        names = dict(ROOT_CAUSE_CLUSTER_MAP)
+    else:
+        names = cluster_names(df["root_cause_clean"], labels)
 
     df.to_csv(OUT_PATH, index=False)
+    save_model(model, vectorizer, names, embedding_model)
 
     print(f"\n✅ Clustering completed")
     print(f"Clusters saved to: {OUT_PATH}")
-    print_cluster_keywords(model, vectorizer)
+    print(f"Model saved to: {MODEL_PATH}")
+
+    if vectorizer is not None:
+        print_cluster_keywords(model, vectorizer)
+    else:
+        print_cluster_examples(df, labels)
+
+    print("\n🔹 Cluster Names:\n")
+    for i, name in names.items():
+        print(f"Cluster {i}: {name}")
 
 
 if __name__ == "__main__":
@@ -3,14 +3,24 @@
 D2: AI-Powered Similar Defect Search (Offline)
 """
 
+import os
+
 import pandas as pd
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from pathlib import Path
-import pickle
 from collections import Counter
 
+import embedding_store
+import ann_index
+import bulk_embed
+import encoder
+from facet_index import FacetIndex, filters_key
+from lexical_index import BM25Index, HYBRID_ALPHA, HYBRID_SHORTLIST, HYBRID_LEXICAL_MATCH
+from search_cache import QUERY_CACHE
+from insight_table import load_insights
+from ai_root_cause_clustering import load_cluster_names, ROOT_CAUSE_CLUSTER_MAP
+
 
 MIN_SIMILARITY = 0.40
 
@@ -25,22 +35,22 @@ def similarity_band(score):
         return "Low"
     
 
-ROOT_CAUSE_CLUSTER_MAP = {
-    0: "Environmental / EMI & Moisture",
-    1: "Maintenance / Calibration / Installation",
-    2: "Environmental Aging / Material Degradation",
-    3: "Mechanical / Vibration / Fasteners",
-    4: "Manufacturing / Material Defect",
-    5: "Design / Operational Limit Exceedance"
-}
+def cluster_name(cluster):
+    # Models saved before names were stored are the curated configuration
+    names = load_cluster_names() or ROOT_CAUSE_CLUSTER_MAP
+    return names.get(int(cluster), f"Cluster {cluster}")
     
 
 DATA_PATH = Path("data/analytics/defect_reports_with_clusters.csv")
+RISK_PATH = Path("data/analytics/defect_reports_with_risk.csv")
 MODEL_NAME = "all-MiniLM-L6-v2"
-EMB_PATH = Path("data/analytics/defect_embeddings.pkl")
+EMB_PATH = embedding_store.EMB_MATRIX_PATH
 
 TEXT_COLS = ["defect_observed", "root_cause"]
 
+# dense: embeddings only | hybrid: BM25 shortlist + fused lexical/semantic score
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "dense")
+
 
 def load_data():
     df = pd.read_csv(DATA_PATH)
@@ -48,66 +58,295 @@ def load_data():
         df["defect_observed"].fillna("") + " " +
         df["root_cause"].fillna("")
     )
+
+    # risk_level is only needed as a search filter; take it from the scored file if present
+    if RISK_PATH.exists() and "risk_level" not in df.columns:
+        risk = pd.read_csv(RISK_PATH, usecols=["case_id", "risk_level"])
+        df = df.merge(risk.drop_duplicates("case_id"), on="case_id", how="left")
     return df
 
 
-def build_embeddings(df):
-    print("Loading NLP model...")
-    model = SentenceTransformer(MODEL_NAME)
+def build_embeddings(df, model=None):
+    if model is None and bulk_embed.EMBED_WORKERS <= 1:
+        print("Loading NLP model...")
+        model = SentenceTransformer(MODEL_NAME)
 
+    # Length-bucketed and streamed to disk; EMBED_WORKERS > 1 encodes in a process pool
     print("Generating embeddings...")
-    embeddings = model.encode(
-        df["combined_text"].tolist(),
-        show_progress_bar=True
+    manifest, _ = bulk_embed.encode_to_store(
+        df["combined_text"].tolist(), df["case_id"], MODEL_NAME, model=model
     )
-
-    with open(EMB_PATH, "wb") as f:
-        pickle.dump(embeddings, f)
+    # New store version -> cached queries/results are stale
+    QUERY_CACHE.bind(manifest["version"])
 
     print(f"Embeddings saved to {EMB_PATH}")
-    return embeddings, model
+    return load_embeddings(), model
 
 
 def load_embeddings():
-    with open(EMB_PATH, "rb") as f:
-        return pickle.load(f)
+    # Read-only memory map of the L2-normalized float32 matrix
+    return embedding_store.load_embeddings()
+
 
+def refresh_embeddings(df, model=None):
+    """
+    Bring the embedding store in line with df, keyed on case_id and a hash
+    of combined_text: only new or changed rows are encoded, deleted rows are
+    dropped, and the store is rewritten in df's row order so results never
+    point at the wrong record. The reference model is only loaded when
+    something needs encoding. Returns (embeddings, model), model being None
+    if none was passed or needed.
+
+    Runs under the store lock: the dashboard, search_service and the CLI
+    all refresh at startup, and only the first one to notice a change
+    rebuilds the store.
+    """
+    with embedding_store.store_lock():
+        return _refresh_embeddings(df, model)
 
-def find_similar(query, df, embeddings, model, top_k=5):
-    query_emb = model.encode([query])
-    sims = cosine_similarity(query_emb, embeddings)[0]
 
-    top_idx = np.argsort(sims)[::-1][:top_k]
+def _refresh_embeddings(df, model=None):
+    if not embedding_store.store_exists():
+        return build_embeddings(df, model)
 
-    results = []
+    old_embeddings, manifest = embedding_store.load_store()
+    if manifest["model_name"] != MODEL_NAME:
+        print(f"Embedding model changed ({manifest['model_name']} -> {MODEL_NAME}), rebuilding...")
+        return build_embeddings(df, model)
 
-    for idx in top_idx:
-        score = float(sims[idx])
+    case_ids = df["case_id"].astype(str).tolist()
+    text_hashes = [embedding_store.text_hash(t) for t in df["combined_text"]]
 
-        if score < MIN_SIMILARITY:
-            continue
+    old_rows = {cid: i for i, cid in enumerate(manifest["case_ids"])}
+    source_rows = np.array([old_rows.get(cid, -1) for cid in case_ids], dtype=np.int64)
+
+    # A changed text means the old vector can't be reused
+    old_hashes = np.asarray(manifest["text_hashes"], dtype=object)
+    carried = source_rows >= 0
+    changed = np.zeros(len(df), dtype=bool)
+    changed[carried] = old_hashes[source_rows[carried]] != np.asarray(text_hashes, dtype=object)[carried]
+    source_rows[changed] = -1
+
+    new_rows = np.flatnonzero(source_rows < 0)
+    n_deleted = len(set(manifest["case_ids"]) - set(case_ids))
+
+    if not len(new_rows) and not n_deleted and np.array_equal(source_rows, np.arange(len(df))):
+        print("Embeddings up to date.")
+        return old_embeddings, model
+
+    print(f"Refreshing embeddings: {len(new_rows) - changed.sum()} new, "
+          f"{changed.sum()} changed, {n_deleted} deleted")
+
+    if model is None:
+        model = SentenceTransformer(MODEL_NAME)
+
+    new_embeddings = np.empty((0, manifest["dim"]), dtype=np.float32)
+    if len(new_rows):
+        new_embeddings = model.encode(
+            df["combined_text"].iloc[new_rows].tolist(),
+            normalize_embeddings=True
+        )
+
+    manifest = embedding_store.update_store(
+        old_embeddings, source_rows, new_rows, new_embeddings,
+        case_ids, text_hashes, MODEL_NAME
+    )
+    QUERY_CACHE.bind(manifest["version"])
+
+    return load_embeddings(), model
+
+
+RESULT_COLS = [
+    "case_id", "system", "defect_observed", "root_cause",
+    "corrective_action", "root_cause_cluster", "preventive_action",
+]
+
+
+def encode_queries(queries, model, cache=None):
+    """
+    Encode queries in one model call, reusing cached query embeddings.
+    """
+    embs = [cache.get_embedding(q) if cache is not None else None for q in queries]
+    todo = [i for i, e in enumerate(embs) if e is None]
+
+    if todo:
+        new = model.encode([queries[i] for i in todo], normalize_embeddings=True)
+        for i, e in zip(todo, new):
+            embs[i] = e
+            if cache is not None:
+                cache.put_embedding(queries[i], e)
+
+    return np.vstack(embs)
+
+
+def search_embeddings(query_embs, df, index, top_k=5, rows=None):
+    """
+    Score encoded queries through the index and build result rows.
+    With rows (a filtered row set) only those rows are scored, exactly.
+    Returns one result list per query.
+    """
+    if rows is None:
+        top_scores, top_idx = index.search(query_embs, top_k)
+    else:
+        top_scores, top_idx = index.search(query_embs, top_k, rows=rows)
+
+    return build_results(top_scores, top_idx, df)
+
+
+def hybrid_search(queries, query_embs, df, embeddings, lexical, top_k=5, rows=None):
+    """
+    Lexical prefilter + score fusion. Each query's BM25 shortlist (within
+    rows, if filtered) is the only set scored densely; candidates are ranked
+    by HYBRID_ALPHA * cosine + (1 - HYBRID_ALPHA) * BM25 / best BM25.
+    Queries with fewer than top_k lexical matches also take the dense top-k
+    as candidates (with zero BM25), so their lexical matches still compete.
+
+    similarity_score stays the cosine similarity, so bands mean the same as
+    in dense search; strong lexical matches (>= HYBRID_LEXICAL_MATCH of the
+    best BM25) are kept even below MIN_SIMILARITY.
+    """
+    exact = ann_index.ExactIndex(embeddings)
+    top_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+    top_idx = np.full((len(queries), top_k), -1, dtype=np.int64)
+    keep = np.zeros((len(queries), top_k), dtype=bool)
+
+    for qi, (query, q) in enumerate(zip(queries, query_embs)):
+        cand, bm25 = lexical.shortlist(query, max(HYBRID_SHORTLIST, top_k), rows)
+
+        if len(cand) < top_k:
+            # Too few lexical matches to fill top_k: add the dense top-k to
+            # them rather than dropping the rare exact-token hits
+            _, idx = exact.search(q, top_k, rows=rows)
+            extra = np.setdiff1d(idx[0][idx[0] >= 0], cand)
+            cand = np.concatenate([cand, extra])
+            bm25 = np.concatenate([bm25, np.zeros(len(extra), dtype=bm25.dtype)])
+            if not len(cand):
+                continue
+
+        dense = np.asarray(embeddings[cand]) @ q
+        lexical_score = bm25 / bm25[0] if bm25[0] > 0 else np.zeros_like(bm25)
+        fused = HYBRID_ALPHA * dense + (1 - HYBRID_ALPHA) * lexical_score
+        _, local = ann_index.top_k_rows(fused, top_k)
+        local = local[0]
+        found = len(local)
+
+        top_scores[qi, :found] = dense[local]
+        top_idx[qi, :found] = cand[local]
+        keep[qi, :found] = (dense[local] >= MIN_SIMILARITY) | (lexical_score[local] >= HYBRID_LEXICAL_MATCH)
+
+    return build_results(top_scores, top_idx, df, keep)
+
+
+def build_results(top_scores, top_idx, df, keep=None):
+    """
+    Turn per-query (score, row) arrays into result dicts. Padding rows (-1)
+    are always dropped; so are scores below MIN_SIMILARITY unless keep says
+    which hits to return.
+    """
+    if keep is None:
+        keep = top_scores >= MIN_SIMILARITY
+    keep = keep & (top_idx >= 0)
+    hit_idx = top_idx[keep]
+    hit_scores = top_scores[keep].astype(float)
+
+    # Gather every hit's fields in one vectorized take per column
+    hits = df.iloc[hit_idx][RESULT_COLS]
+    root_cause = hits["root_cause"].where(
+        hits["root_cause"].notna(), "Not explicitly stated in report"
+    )
+    columns = {
+        "case_id": hits["case_id"].tolist(),
+        "system": hits["system"].tolist(),
+        "defect": hits["defect_observed"].tolist(),
+        "root_cause": root_cause.tolist(),
+        "corrective_action": hits["corrective_action"].tolist(),
+        "root_cause_cluster": hits["root_cause_cluster"].tolist(),
+        "preventive_action": hits["preventive_action"].tolist(),
+        "similarity_score": np.round(hit_scores, 3).tolist(),
+        "similarity_band": [similarity_band(sc) for sc in hit_scores],
+    }
+    rows = [dict(zip(columns, vals)) for vals in zip(*columns.values())]
+
+    # Split the flat hit list back into per-query lists
+    bounds = np.concatenate([[0], np.cumsum(keep.sum(axis=1))])
+    return [rows[bounds[i]:bounds[i + 1]] for i in range(len(top_idx))]
 
-        results.append({
-            "case_id": df.iloc[idx]["case_id"],
-            "system": df.iloc[idx]["system"],
-            "defect": df.iloc[idx]["defect_observed"],
-            "root_cause": df.iloc[idx]["root_cause"]
-                if pd.notna(df.iloc[idx]["root_cause"])
-                else "Not explicitly stated in report",
-            "corrective_action": df.iloc[idx]["corrective_action"],
-            "root_cause_cluster": df.iloc[idx]["root_cause_cluster"],
-            "preventive_action": df.iloc[idx]["preventive_action"],
-            "similarity_score": round(score, 3),
-            "similarity_band": similarity_band(score)
-    })
 
+def find_similar_batch(queries, df, embeddings, model, top_k=5, index=None, cache=None,
+                       filters=None, facets=None, lexical=None):
+    """
+    Similar-defect search for many queries at once: one encode call, one
+    scoring pass (matrix product + partial top-k) and one row gather for all
+    hits. Returns one result list per query, same format as find_similar.
+
+    filters restricts the search to matching records, e.g.
+    {"system": "Landing Gear", "risk_level": ["High", "Medium"],
+     "date_from": "2023-01-01", "date_to": "2023-12-31"}.
+    The row set comes from the precomputed bitmaps in facets (a FacetIndex
+    built once per df) and is applied before scoring, so top_k is taken among
+    matching records only.
 
+    With lexical (a BM25Index over the same df) the search is hybrid: see
+    hybrid_search.
+
+    With a SearchCache, repeated queries skip encoding and scoring entirely.
+    """
+    queries = list(queries)
+    if not queries:
+        return []
+
+    # Rows are unit-length, so cosine similarity is a plain dot product;
+    # an ANN index (ann_index.load_index) answers the same top-k approximately
+    if index is None:
+        index = ann_index.ExactIndex(embeddings)
+
+    rows = None
+    if filters:
+        if facets is None:
+            facets = FacetIndex(df)
+        rows = facets.select(filters)
+        if rows is not None:
+            if not len(rows):
+                return [[] for _ in queries]
+            # ANN structures can't be restricted to a row set; the filtered
+            # subset is scored exactly, which costs less than a full scan
+            if not getattr(index, "supports_rows", False):
+                index = ann_index.ExactIndex(embeddings)
+
+    mode = "hybrid" if lexical is not None else "dense"
+    params = (top_k, index.kind, filters_key(filters), mode)
+    results = [cache.get_results(q, params) if cache is not None else None for q in queries]
+    todo = [i for i, r in enumerate(results) if r is None]
+
+    if todo:
+        todo_queries = [queries[i] for i in todo]
+        query_embs = encode_queries(todo_queries, model, cache)
+        if lexical is not None:
+            found = hybrid_search(todo_queries, query_embs, df, embeddings, lexical, top_k, rows)
+        else:
+            found = search_embeddings(query_embs, df, index, top_k, rows)
+        for i, res in zip(todo, found):
+            results[i] = res
+            if cache is not None:
+                cache.put_results(queries[i], res, params)
 
     return results
 
-def generate_ai_insight(similar_cases):
+
+def find_similar(query, df, embeddings, model, top_k=5, index=None, cache=None,
+                 filters=None, facets=None, lexical=None):
+    return find_similar_batch([query], df, embeddings, model, top_k, index, cache,
+                              filters, facets, lexical)[0]
+
+def generate_ai_insight(similar_cases, insights=None):
     """
     Generate explainable AI insight from similar defect cases
+
+    The similar cases pick the root cause cluster (and the system most of
+    them share). With insights (an insight_table.InsightTable), actions are
+    ranked over every past report of that cluster in that system, and the
+    insight also carries corrective actions and recurrence; without it,
+    only the similar cases themselves are counted.
     """
     valid_cases = [
         c for c in similar_cases
@@ -121,6 +360,31 @@ def generate_ai_insight(similar_cases):
     clusters = [c["root_cause_cluster"] for c in valid_cases]
     dominant_cluster = Counter(clusters).most_common(1)[0][0]
 
+    # Confidence score (simple & explainable)
+    confidence = min(len(valid_cases) / 10, 1.0)
+
+    history = None
+    if insights is not None:
+        systems = [
+            c["system"] for c in valid_cases
+            if c["root_cause_cluster"] == dominant_cluster and c.get("system")
+        ]
+        system = Counter(systems).most_common(1)[0][0] if systems else None
+        history = insights.lookup(dominant_cluster, system)
+
+    if history is not None:
+        return {
+            "predicted_root_cause": cluster_name(dominant_cluster),
+            "confidence": round(confidence, 2),
+            "recommended_preventive_actions": [
+                act for act, _ in history["preventive_actions"][:3]
+            ],
+            "recommended_corrective_actions": [
+                act for act, _ in history["corrective_actions"][:3]
+            ],
+            "history": history,
+        }
+
     # Preventive action aggregation
     preventive_actions = [
         c["preventive_action"]
@@ -132,13 +396,8 @@ def generate_ai_insight(similar_cases):
         act for act, _ in Counter(preventive_actions).most_common(3)
     ]
 
-    # Confidence score (simple & explainable)
-    confidence = min(len(valid_cases) / 10, 1.0)
-
     return {
-        "predicted_root_cause": ROOT_CAUSE_CLUSTER_MAP.get(
-            dominant_cluster, "Unknown"
-        ),
+        "predicted_root_cause": cluster_name(dominant_cluster),
         "confidence": round(confidence, 2),
         "recommended_preventive_actions": top_actions
     }
@@ -149,12 +408,17 @@ def generate_ai_insight(similar_cases):
 def main():
     df = load_data()
 
-    if not EMB_PATH.exists():
-        embeddings, model = build_embeddings(df)
-    else:
-        print("Loading existing embeddings...")
-        embeddings = load_embeddings()
-        model = SentenceTransformer(MODEL_NAME)
+    print("Loading NLP model...")
+    model = encoder.load_encoder(MODEL_NAME)
+    # Corpus vectors always come from the reference model
+    reference = model if encoder.ENCODER_BACKEND == "torch" else None
+    embeddings, _ = refresh_embeddings(df, reference)
+
+    manifest = embedding_store.load_manifest()
+    index = ann_index.load_index(embeddings=embeddings, manifest=manifest)
+    QUERY_CACHE.bind(manifest["version"])
+    lexical = BM25Index.from_df(df) if SEARCH_MODE == "hybrid" else None
+    insights = load_insights(df)
 
     print("\nAI Similar Defect Search Ready!")
     print("Type a defect description (or 'exit'):\n")
@@ -169,7 +433,8 @@ def main():
         if query.lower() == "exit":
             break
 
-        results = find_similar(query, df, embeddings, model)
+        results = find_similar(query, df, embeddings, model, index=index, cache=QUERY_CACHE,
+                               lexical=lexical)
         if not results:
             print("\n❌ No relevant defects found for the given description.\n")
             continue
@@ -187,7 +452,7 @@ def main():
 
         max_similarity = max(r['similarity_score'] for r in results)    
         if max_similarity >= 0.50:
-            ai_insight = generate_ai_insight(results)
+            ai_insight = generate_ai_insight(results, insights)
         else:
             ai_insight = None
             print("\nℹ️ Similar matches found, but confidence is too low to generate AI insight.\n")
@@ -202,6 +467,17 @@ def main():
             for act in ai_insight["recommended_preventive_actions"]:
                 print(f"• {act}")
 
+            history = ai_insight.get("history")
+            if history:
+                print("\nRecommended Corrective Actions:")
+                for act in ai_insight["recommended_corrective_actions"]:
+                    print(f"• {act}")
+                scope = "all systems" if history["system"] == "*" else history["system"]
+                print(f"\nRecurrence ({scope}): {history['reports']} past reports over "
+                      f"{history['months_active']} months ({history['first_seen']} to {history['last_seen']})")
+                for part, n in history["recurring_parts"]:
+                    print(f"• {part}: {n} reports")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,433 @@
+# ann_index.py
+"""
+D2b: Approximate Nearest-Neighbor Index for Similar Defect Search
+
+Pluggable top-k search over the embedding store:
+- exact : brute-force dot product (always available; fallback + ground truth)
+- ivf   : inverted file (coarse k-means partitions, probe the nearest lists)
+- hnsw  : hierarchical navigable small-world graph (needs hnswlib)
+- int8 / fp16 : quantized copy of the store scanned in memory; the best
+                candidates are re-ranked exactly against the float32 store
+- sharded : store split by year / size, shards searched in parallel
+            (see sharded_store.py)
+
+Indexes are built offline (python ann_index.py) and persisted next to the
+embeddings. Each index records the store version it was built from; a stale
+or missing index falls back to exact search.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+from pathlib import Path
+from sklearn.cluster import MiniBatchKMeans
+
+import embedding_store
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+INDEX_DIR = embedding_store.EMB_MATRIX_PATH.parent
+INDEX_PREFIX = embedding_store.EMB_MATRIX_PATH.stem
+
+# Backend used by search callers (exact | ivf | hnsw | int8 | fp16 | sharded)
+SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "exact")
+
+# IVF: more lists -> smaller lists to scan; more probes -> higher recall, slower
+IVF_NLIST = int(os.environ.get("IVF_NLIST", 0))          # 0 = 4 * sqrt(n)
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", 8))
+IVF_TRAIN_SAMPLE = 100_000
+
+# HNSW: higher M / ef_construction -> better graph, slower build;
+# higher ef -> higher recall, slower queries
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF = int(os.environ.get("HNSW_EF", 64))
+
+# Quantized: first pass keeps k * QUANT_RERANK candidates for exact re-ranking
+QUANT_RERANK = int(os.environ.get("QUANT_RERANK", 4))
+# Rows dequantized per step; small enough that the float32 copy stays in cache
+QUANT_BLOCK = 512
+
+ASSIGN_BATCH = 65_536
+EXACT_BLOCK_SCORES = 2 ** 26     # ~256 MB of float32 scores per block
+
+
+def top_k_rows(scores, k):
+    """
+    Top-k per row by partial selection (no full sort of every score).
+    Returns (top_scores, top_idx), each sorted descending.
+    """
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty, empty.astype(int)
+
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    # Descending score, ties broken by row index so results are deterministic
+    order = np.lexsort((idx, -part), axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+class ExactIndex:
+    kind = "exact"
+    supports_rows = True
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, queries, k, rows=None):
+        """
+        rows: optional sorted row positions to restrict the search to (e.g. a
+        metadata filter); only those rows are read and scored.
+        """
+        queries = np.atleast_2d(queries)
+        vectors = self.embeddings if rows is None else self.embeddings[rows]
+
+        # Score queries in blocks so the score matrix stays ~EXACT_BLOCK_SCORES floats
+        block = max(1, EXACT_BLOCK_SCORES // max(1, len(vectors)))
+        results = [
+            top_k_rows(queries[start:start + block] @ vectors.T, k)
+            for start in range(0, len(queries), block)
+        ]
+        scores, ids = np.vstack([r[0] for r in results]), np.vstack([r[1] for r in results])
+        return scores, (ids if rows is None else rows[ids])
+
+
+class IVFIndex:
+    kind = "ivf"
+
+    def __init__(self, centroids, vectors, row_ids, offsets, version, nprobe=IVF_NPROBE):
+        self.centroids = centroids      # (nlist, dim), unit length
+        self.vectors = vectors          # embeddings reordered so each list is contiguous
+        self.row_ids = row_ids          # position in list order -> original row
+        self.offsets = offsets          # list i spans offsets[i]:offsets[i + 1]
+        self.version = version
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, embeddings, version, nlist=IVF_NLIST, nprobe=IVF_NPROBE):
+        n = len(embeddings)
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        nlist = min(nlist, n)
+
+        rng = np.random.default_rng(42)
+        sample = embeddings[np.sort(rng.choice(n, size=min(n, IVF_TRAIN_SAMPLE), replace=False))]
+        kmeans = MiniBatchKMeans(n_clusters=nlist, random_state=42, n_init=1, batch_size=4096)
+        kmeans.fit(sample)
+        centroids = embedding_store.normalize(kmeans.cluster_centers_)
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, ASSIGN_BATCH):
+            block = np.asarray(embeddings[start:start + ASSIGN_BATCH])
+            assign[start:start + ASSIGN_BATCH] = np.argmax(block @ centroids.T, axis=1)
+
+        row_ids = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        vectors = np.ascontiguousarray(embeddings[row_ids], dtype=np.float32)
+
+        return cls(centroids, vectors, row_ids, offsets, version, nprobe)
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        _, probes = top_k_rows(queries @ self.centroids.T, nprobe)
+
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+        for qi, q in enumerate(queries):
+            positions = np.concatenate([
+                np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes[qi]
+            ])
+            scores, local = top_k_rows(self.vectors[positions] @ q, k)
+            found = scores.shape[1]
+            all_scores[qi, :found] = scores[0]
+            all_ids[qi, :found] = self.row_ids[positions[local[0]]]
+
+        return all_scores, all_ids
+
+    def save(self, prefix):
+        np.save(prefix.with_suffix(".ivf.npy"), self.vectors)
+        np.savez(
+            prefix.with_suffix(".ivf.npz"),
+            centroids=self.centroids,
+            row_ids=self.row_ids,
+            offsets=self.offsets,
+            version=self.version,
+        )
+
+    @classmethod
+    def load(cls, prefix, nprobe=IVF_NPROBE):
+        meta = np.load(prefix.with_suffix(".ivf.npz"))
+        vectors = np.load(prefix.with_suffix(".ivf.npy"), mmap_mode="r")
+        return cls(meta["centroids"], vectors, meta["row_ids"], meta["offsets"],
+                   str(meta["version"]), nprobe)
+
+
+class HNSWIndex:
+    kind = "hnsw"
+
+    def __init__(self, index, version, ef=HNSW_EF):
+        self.index = index
+        self.version = version
+        self.set_ef(ef)
+
+    def set_ef(self, ef):
+        self.ef = ef
+        self.index.set_ef(ef)
+
+    @classmethod
+    def build(cls, embeddings, version, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef=HNSW_EF):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw index (pip install hnswlib)")
+
+        n, dim = embeddings.shape
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.init_index(max_elements=n, M=m, ef_construction=ef_construction, random_seed=42)
+
+        for start in range(0, n, ASSIGN_BATCH):
+            block = np.asarray(embeddings[start:start + ASSIGN_BATCH])
+            index.add_items(block, np.arange(start, start + len(block)))
+
+        return cls(index, version, ef)
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(queries).astype(np.float32)
+        k = min(k, self.index.get_current_count())
+        if self.ef < k:
+            self.set_ef(k)
+        labels, distances = self.index.knn_query(queries, k=k)
+        # hnswlib "ip" distance is 1 - dot product
+        return 1.0 - distances, labels.astype(np.int64)
+
+    def save(self, prefix):
+        self.index.save_index(str(prefix.with_suffix(".hnsw.bin")))
+        prefix.with_suffix(".hnsw.json").write_text(
+            json.dumps({"version": self.version, "count": self.index.get_current_count()}),
+            encoding="utf-8",
+        )
+
+    @classmethod
+    def load(cls, prefix, dim, ef=HNSW_EF):
+        if hnswlib is None:
+            raise ImportError("hnswlib is required for the hnsw index (pip install hnswlib)")
+
+        meta = json.loads(prefix.with_suffix(".hnsw.json").read_text(encoding="utf-8"))
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.load_index(str(prefix.with_suffix(".hnsw.bin")), max_elements=meta["count"])
+        return cls(index, meta["version"], ef)
+
+
+class QuantizedIndex:
+    """
+    Compressed copy of the store kept in memory (int8: 4x smaller, with a
+    per-row scale; fp16: 2x smaller). Every row is scored against the
+    compressed copy, then the top k * rerank candidates are re-scored against
+    the float32 store, which stays on disk and is only touched for those rows.
+
+    It saves memory, not time. numpy has no native int8/fp16 matrix-vector
+    product, so the first pass converts blocks to float32, and a query is
+    3-8x slower than ExactIndex (measured at 20k rows). Pick it to fit a
+    large store in RAM, never for latency.
+    """
+
+    DTYPES = {"int8": np.int8, "fp16": np.float16}
+
+    def __init__(self, codes, scales, embeddings, version, kind, rerank=QUANT_RERANK):
+        self.codes = codes              # (n, dim) int8 or float16
+        self.scales = scales            # per-row dequantization scale (ones for fp16)
+        self.embeddings = embeddings    # full-precision store, memory-mapped
+        self.version = version
+        self.kind = kind
+        self.rerank = rerank
+
+    @classmethod
+    def build(cls, embeddings, version, kind="int8", rerank=QUANT_RERANK):
+        n, dim = embeddings.shape
+        codes = np.empty((n, dim), dtype=cls.DTYPES[kind])
+        scales = np.ones(n, dtype=np.float32)
+
+        for start in range(0, n, ASSIGN_BATCH):
+            block = np.asarray(embeddings[start:start + ASSIGN_BATCH], dtype=np.float32)
+            if kind == "int8":
+                # Symmetric per-row scale: the largest component maps to +/-127
+                amax = np.abs(block).max(axis=1)
+                amax[amax == 0] = 1.0
+                scales[start:start + len(block)] = amax / 127.0
+                block = np.rint(block / scales[start:start + len(block), None])
+            codes[start:start + len(block)] = block
+
+        return cls(codes, scales, embeddings, version, kind, rerank)
+
+    def approx_scores(self, queries):
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), QUANT_BLOCK):
+            block = self.codes[start:start + QUANT_BLOCK].astype(np.float32)
+            scores[:, start:start + len(block)] = (
+                (queries @ block.T) * self.scales[start:start + len(block)]
+            )
+        return scores
+
+    def search(self, queries, k):
+        queries = np.atleast_2d(queries).astype(np.float32)
+        shortlist = min(len(self.codes), k * self.rerank)
+
+        all_scores, all_ids = [], []
+        block = max(1, EXACT_BLOCK_SCORES // max(1, len(self.codes)))
+        for start in range(0, len(queries), block):
+            q = queries[start:start + block]
+            _, cand = top_k_rows(self.approx_scores(q), shortlist)
+
+            # Read each candidate row from disk once, in file order
+            rows, pos = np.unique(cand, return_inverse=True)
+            vectors = np.asarray(self.embeddings[rows], dtype=np.float32)
+            exact = np.einsum("qd,qcd->qc", q, vectors[pos.reshape(cand.shape)])
+
+            scores, local = top_k_rows(exact, k)
+            all_scores.append(scores)
+            all_ids.append(np.take_along_axis(cand, local, axis=1))
+
+        return np.vstack(all_scores), np.vstack(all_ids)
+
+    def save(self, prefix):
+        np.save(prefix.with_suffix(f".{self.kind}.npy"), self.codes)
+        np.savez(prefix.with_suffix(f".{self.kind}.npz"), scales=self.scales, version=self.version)
+
+    @classmethod
+    def load(cls, prefix, kind, embeddings, rerank=QUANT_RERANK):
+        # The compressed copy is the hot path, so it is read fully into memory
+        codes = np.load(prefix.with_suffix(f".{kind}.npy"))
+        meta = np.load(prefix.with_suffix(f".{kind}.npz"))
+        return cls(codes, meta["scales"], embeddings, str(meta["version"]), kind, rerank)
+
+
+INDEX_TYPES = {"ivf": IVFIndex, "hnsw": HNSWIndex, "int8": QuantizedIndex, "fp16": QuantizedIndex}
+
+
+def index_prefix(index_dir=INDEX_DIR):
+    return Path(index_dir) / INDEX_PREFIX
+
+
+def build_index(kind=SEARCH_INDEX, embeddings=None, manifest=None, index_dir=INDEX_DIR):
+    if embeddings is None or manifest is None:
+        embeddings, manifest = embedding_store.load_store()
+
+    if kind == "exact":
+        return ExactIndex(embeddings)
+
+    if kind == "sharded":
+        import sharded_store
+        shard_dir = Path(index_dir) / sharded_store.SHARD_DIR.name
+        sharded_store.build_shards(embeddings, manifest, shard_dir)
+        return sharded_store.ShardedIndex.load(shard_dir)
+
+    if kind in QuantizedIndex.DTYPES:
+        index = QuantizedIndex.build(embeddings, manifest["version"], kind)
+    else:
+        index = INDEX_TYPES[kind].build(embeddings, manifest["version"])
+    index.save(index_prefix(index_dir))
+    return index
+
+
+def load_index(kind=SEARCH_INDEX, embeddings=None, manifest=None, index_dir=INDEX_DIR):
+    """
+    Load the configured index, falling back to exact search when the index
+    is missing, stale (built from another store version) or its backend is
+    not installed.
+    """
+    if embeddings is None or manifest is None:
+        embeddings, manifest = embedding_store.load_store()
+
+    if kind == "exact":
+        return ExactIndex(embeddings)
+
+    prefix = index_prefix(index_dir)
+    try:
+        if kind == "sharded":
+            import sharded_store
+            index = sharded_store.ShardedIndex.load(Path(index_dir) / sharded_store.SHARD_DIR.name)
+        elif kind == "hnsw":
+            index = HNSWIndex.load(prefix, manifest["dim"])
+        elif kind in QuantizedIndex.DTYPES:
+            index = QuantizedIndex.load(prefix, kind, embeddings)
+        else:
+            index = INDEX_TYPES[kind].load(prefix)
+    except (FileNotFoundError, ImportError, KeyError) as e:
+        print(f"⚠️ {kind} index unavailable ({e}); using exact search")
+        return ExactIndex(embeddings)
+
+    if index.version != manifest["version"]:
+        print(f"⚠️ {kind} index is stale (built for store {index.version}); using exact search")
+        return ExactIndex(embeddings)
+
+    return index
+
+
+def recall_at_k(index, exact, queries, k=10):
+    """
+    Mean fraction of the exact top-k that the index also returns.
+    """
+    _, truth = exact.search(queries, k)
+    _, found = index.search(queries, k)
+    return float(np.mean([len(set(t) & set(f)) / len(t) for t, f in zip(truth, found)]))
+
+
+def query_ms(index, queries, k=10):
+    # Mean single-query latency (queries issued one at a time, as in search)
+    start = time.perf_counter()
+    for q in queries:
+        index.search(q[None, :], k)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def index_nbytes(index):
+    # In-memory footprint of the data each backend scans per query
+    if isinstance(index, QuantizedIndex):
+        return index.codes.nbytes + index.scales.nbytes
+    if isinstance(index, IVFIndex):
+        return index.vectors.nbytes + index.centroids.nbytes
+    if isinstance(index, ExactIndex):
+        return index.embeddings.nbytes
+    return None
+
+
+def main():
+    embeddings, manifest = embedding_store.load_store()
+    exact = ExactIndex(embeddings)
+
+    # Held-out check: stored rows used as queries, recall@10 against exact search
+    rng = np.random.default_rng(0)
+    queries = np.asarray(embeddings[np.sort(rng.choice(len(embeddings), size=min(200, len(embeddings)),
+                                                       replace=False))])
+
+    kinds = [SEARCH_INDEX] if SEARCH_INDEX != "exact" else (
+        ["ivf"] + (["hnsw"] if hnswlib else []) + list(QuantizedIndex.DTYPES)
+    )
+    exact_ms = query_ms(exact, queries)
+    for kind in kinds:
+        start = time.perf_counter()
+        index = build_index(kind, embeddings, manifest)
+        print(f"✅ Built {kind} index over {manifest['count']:,} vectors "
+              f"in {time.perf_counter() - start:.2f}s")
+
+        nbytes = index_nbytes(index)
+        memory = f"{nbytes / 2**20:.1f} MB vs {exact.embeddings.nbytes / 2**20:.1f} MB float32, " if nbytes else ""
+        print(f"   {memory}recall@10 = {recall_at_k(index, exact, queries):.3f}")
+
+        ms = query_ms(index, queries)
+        print(f"   {ms:.2f} ms/query vs {exact_ms:.2f} ms exact ({ms / exact_ms:.1f}x)")
+        if isinstance(index, QuantizedIndex):
+            print("   ⚠️ Quantized search trades latency for memory: use it to fit the store in RAM, not for speed")
+
+    print(f"Indexes saved in: {INDEX_DIR}")
+
+
+if __name__ == "__main__":
+    main()
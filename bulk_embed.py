@@ -0,0 +1,154 @@
+# bulk_embed.py
+"""
+Bulk (re-)embedding of the defect corpus into the embedding store.
+
+- Texts are ordered by length and cut into chunks, so each encode batch
+  holds texts of similar length and little compute goes to padding.
+- Chunks are encoded by a pool of worker processes, each loading the model
+  once and using an equal share of the CPU threads (no oversubscription).
+  Longest chunks are dispatched first so the pool finishes evenly.
+- Results are written to the store as they complete (StoreWriter), so
+  memory stays bounded by the chunks in flight, not the corpus.
+
+Run: python bulk_embed.py  (EMBED_WORKERS to set the pool size)
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing as mp
+
+import numpy as np
+
+import embedding_store
+
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", 1))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))
+EMBED_CHUNK_SIZE = int(os.environ.get("EMBED_CHUNK_SIZE", 2048))    # texts per task
+IN_FLIGHT_PER_WORKER = 2        # queued chunks per worker, so none sits idle between tasks
+
+_worker_model = None
+
+
+def length_chunks(texts, chunk_size=EMBED_CHUNK_SIZE):
+    """
+    Row positions grouped into chunks of similar text length, longest
+    chunks first. Word count stands in for token count: it orders texts
+    the same way without loading a tokenizer in the parent.
+    """
+    lengths = np.fromiter((len(str(t).split()) for t in texts), dtype=np.int64, count=len(texts))
+    order = np.argsort(-lengths, kind="stable")
+    return [order[start:start + chunk_size] for start in range(0, len(order), chunk_size)]
+
+
+def _init_worker(model_name, threads):
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def _encode_chunk(rows, texts, batch_size):
+    return rows, _worker_model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+
+
+def encode_to_store(texts, case_ids, model_name, model=None, workers=EMBED_WORKERS,
+                    batch_size=EMBED_BATCH_SIZE, chunk_size=EMBED_CHUNK_SIZE,
+                    matrix_path=embedding_store.EMB_MATRIX_PATH,
+                    manifest_path=embedding_store.MANIFEST_PATH):
+    """
+    Encode every text and write the store. With workers == 1 the given (or
+    a freshly loaded) model encodes in-process; otherwise a process pool
+    does. Returns (manifest, stats).
+    """
+    texts = [str(t) for t in texts]
+    chunks = length_chunks(texts, chunk_size)
+    writer = None
+    done = 0
+    start = time.perf_counter()
+
+    def write(rows, embeddings):
+        nonlocal writer, done
+        if writer is None:
+            writer = embedding_store.StoreWriter(len(texts), embeddings.shape[1],
+                                                 matrix_path, manifest_path)
+        writer.write(rows, embeddings)
+        done += len(rows)
+        rate = done / max(time.perf_counter() - start, 1e-9)
+        print(f"  {done:,}/{len(texts):,} sentences ({rate:,.0f}/s)", end="\r")
+
+    try:
+        if workers <= 1:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(model_name)
+            for rows in chunks:
+                write(rows, model.encode([texts[i] for i in rows], batch_size=batch_size,
+                                         normalize_embeddings=True))
+        else:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            # spawn: forking a process that already loaded torch can deadlock
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model_name, threads),
+            ) as pool:
+                # Bounded window: a finished chunk is written and dropped
+                # before the next is submitted, so the parent never holds
+                # more than IN_FLIGHT_PER_WORKER * workers results
+                pending = iter(chunks)
+                in_flight = set()
+                while True:
+                    while len(in_flight) < IN_FLIGHT_PER_WORKER * workers:
+                        rows = next(pending, None)
+                        if rows is None:
+                            break
+                        in_flight.add(pool.submit(_encode_chunk, rows, [texts[i] for i in rows],
+                                                  batch_size))
+                    if not in_flight:
+                        break
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        write(*future.result())
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is None:
+        raise ValueError("No texts to encode")
+
+    manifest = writer.close(case_ids, texts, model_name)
+    seconds = time.perf_counter() - start
+    stats = {
+        "sentences": len(texts),
+        "workers": workers,
+        "seconds": round(seconds, 2),
+        "sentences_per_sec": round(len(texts) / max(seconds, 1e-9), 1),
+    }
+    print(f"\n✅ Encoded {stats['sentences']:,} sentences with {workers} worker(s) in "
+          f"{stats['seconds']:.1f}s ({stats['sentences_per_sec']:,.0f} sentences/sec)")
+    return manifest, stats
+
+
+def main():
+    from ai_similarity_search import load_data, MODEL_NAME
+    from search_cache import QUERY_CACHE
+
+    df = load_data()
+    workers = EMBED_WORKERS if "EMBED_WORKERS" in os.environ else max(1, (os.cpu_count() or 2) // 2)
+    print(f"Re-embedding {len(df):,} records with {workers} worker(s)...")
+
+    manifest, _ = encode_to_store(df["combined_text"].tolist(), df["case_id"], MODEL_NAME,
+                                  workers=workers)
+    QUERY_CACHE.bind(manifest["version"])
+    print(f"Embeddings saved to {embedding_store.EMB_MATRIX_PATH} (store {manifest['version']})")
+
+
+if __name__ == "__main__":
+    # Run through the module so pool workers can import the task functions
+    import bulk_embed
+    bulk_embed.main()
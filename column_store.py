@@ -0,0 +1,237 @@
+# column_store.py
+"""
+Typed columnar copy of the risk-scored table for the dashboard.
+
+Each column is its own .npy file under COLUMN_DIR, so a view reads only
+the columns it needs:
+- numeric columns as their numpy dtype
+- dates as datetime64[D], with month (YYYY-MM) precomputed here once
+- repetitive strings (system, trade, risk_level, ...) dictionary-encoded:
+  small integer codes + the distinct values, read back as pd.Categorical
+- free text (TEXT_COLUMNS and other mostly-unique strings) as one UTF-8
+  buffer plus row offsets; the buffer is memory-mapped, so one record's
+  text is read without touching the rest
+
+columns.json lists every column's kind and the table version (a digest of
+the data), which the dashboard uses to key its caches, and names the
+v<version> subdirectory holding the files. A rewrite builds a new
+subdirectory and then swaps columns.json, so a reader (another dashboard
+session) always sees one complete version.
+
+Written by ai_risk_scoring.py next to its CSV; python column_store.py
+(re)builds it from the CSV.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import embedding_store
+
+DATA_PATH = Path("data/analytics/defect_reports_with_risk.csv")
+COLUMN_DIR = Path("data/analytics/dashboard_columns")
+COLUMN_META = "columns.json"
+
+DATE_COLUMNS = ["date_of_occurrence"]
+# Report narrative: always stored as text, shown when a record is opened
+TEXT_COLUMNS = [
+    "defect_observed", "root_cause", "findings", "corrective_action", "preventive_action",
+    "remarks_investigation", "remarks_design", "remarks_quality", "remarks_user",
+    "remarks_ordaqa", "remarks_cemilac",
+]
+# Strings with at most this share of distinct values are dictionary-encoded
+CATEGORY_MAX_SHARE = 0.5
+
+
+def column_kind(series):
+    if series.name in DATE_COLUMNS:
+        return "date"
+    if series.name in TEXT_COLUMNS:
+        return "text"
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return "numeric"
+    if series.nunique(dropna=True) <= CATEGORY_MAX_SHARE * max(len(series), 1):
+        return "category"
+    return "text"
+
+
+def table_version(df):
+    digest = hashlib.sha1(",".join(df.columns).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()[:12]
+
+
+def _save(path, array):
+    embedding_store._atomic_write(path, lambda f: np.save(f, array, allow_pickle=False))
+
+
+def write_columns(df, column_dir=COLUMN_DIR):
+    """
+    Write df (plus the derived month column) as typed columns. Returns the
+    column metadata.
+    """
+    column_dir = Path(column_dir)
+    column_dir.mkdir(parents=True, exist_ok=True)
+
+    df = df.copy()
+    if "date_of_occurrence" in df.columns:
+        dates = pd.to_datetime(df["date_of_occurrence"], dayfirst=True, errors="coerce")
+        df["date_of_occurrence"] = dates
+        df["month"] = dates.dt.to_period("M").astype(str).where(dates.notna(), "Unknown")
+    else:
+        df["month"] = "Unknown"
+
+    version = table_version(df)
+    version_dir = f"v{version}"
+    # Built beside the live version, never inside it; unique per writer, as
+    # dashboard sessions are threads of one process and may rebuild together
+    build_dir = Path(tempfile.mkdtemp(dir=column_dir, prefix=f".{version_dir}.", suffix=".tmp"))
+
+    columns = {}
+    for name in df.columns:
+        series = df[name]
+        kind = column_kind(series)
+
+        if kind == "date":
+            _save(build_dir / f"{name}.npy", series.to_numpy(dtype="datetime64[D]"))
+        elif kind == "numeric":
+            _save(build_dir / f"{name}.npy", series.to_numpy())
+        elif kind == "category":
+            cat = pd.Categorical(series.astype("string").to_numpy(na_value=None))
+            _save(build_dir / f"{name}.codes.npy", cat.codes.astype(np.int32))
+            columns[name] = {"kind": kind, "categories": [str(c) for c in cat.categories]}
+            continue
+        else:
+            encoded = [b"" if pd.isna(v) else str(v).encode("utf-8") for v in series]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            _save(build_dir / f"{name}.offsets.npy", offsets)
+            _save(build_dir / f"{name}.utf8.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+            _save(build_dir / f"{name}.null.npy", series.isna().to_numpy())
+
+        columns[name] = {"kind": kind, "dtype": str(series.dtype)}
+
+    try:
+        os.replace(build_dir, column_dir / version_dir)
+    except OSError:
+        # Another writer landed this version first: same data, keep theirs
+        if not (column_dir / version_dir).is_dir():
+            raise
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    try:
+        previous = load_meta(column_dir).get("data_dir", "")
+    except FileNotFoundError:
+        previous = None
+
+    meta = {"version": version, "count": len(df), "data_dir": version_dir, "columns": columns}
+    embedding_store._atomic_write(
+        column_dir / COLUMN_META, lambda f: f.write(json.dumps(meta, indent=2).encode("utf-8"))
+    )
+
+    # Keep the version sessions may still be reading; drop anything older
+    for old in column_dir.glob("v*"):
+        if old.is_dir() and old.name not in (version_dir, previous):
+            shutil.rmtree(old, ignore_errors=True)
+    if previous != "":                           # files of the old flat layout
+        for old in column_dir.glob("*.npy"):
+            old.unlink(missing_ok=True)
+    return meta
+
+
+def load_meta(column_dir=COLUMN_DIR):
+    path = Path(column_dir) / COLUMN_META
+    if not path.exists():
+        raise FileNotFoundError(f"Column store not found: {path}")
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def column_store_exists(column_dir=COLUMN_DIR):
+    return (Path(column_dir) / COLUMN_META).exists()
+
+
+def data_dir(meta, column_dir=COLUMN_DIR):
+    # Stores written before versioned subdirectories keep files at the top
+    return Path(column_dir) / meta.get("data_dir", "")
+
+
+def _text_values(column_dir, name, rows=None):
+    offsets = np.load(column_dir / f"{name}.offsets.npy", mmap_mode="r")
+    buffer = np.load(column_dir / f"{name}.utf8.npy", mmap_mode="r")
+    nulls = np.load(column_dir / f"{name}.null.npy", mmap_mode="r")
+    rows = range(len(offsets) - 1) if rows is None else rows
+    return [
+        None if nulls[r] else bytes(buffer[offsets[r]:offsets[r + 1]]).decode("utf-8")
+        for r in rows
+    ]
+
+
+def read_columns(columns, column_dir=COLUMN_DIR, meta=None):
+    """
+    DataFrame of just the requested columns (missing ones are skipped).
+    """
+    meta = meta or load_meta(column_dir)
+    column_dir = data_dir(meta, column_dir)
+
+    data = {}
+    for name in columns:
+        info = meta["columns"].get(name)
+        if info is None:
+            continue
+        if info["kind"] == "category":
+            codes = np.load(column_dir / f"{name}.codes.npy")
+            data[name] = pd.Categorical.from_codes(codes, categories=info["categories"])
+        elif info["kind"] == "text":
+            data[name] = _text_values(column_dir, name)
+        else:
+            data[name] = np.load(column_dir / f"{name}.npy")
+
+    return pd.DataFrame(data, index=pd.RangeIndex(meta["count"]))
+
+
+def read_record(row, columns=None, column_dir=COLUMN_DIR, meta=None):
+    """
+    {column: value} for one row, reading only that row's slice of each
+    column (free text included).
+    """
+    meta = meta or load_meta(column_dir)
+    column_dir = data_dir(meta, column_dir)
+    columns = columns or list(meta["columns"])
+
+    record = {}
+    for name in columns:
+        info = meta["columns"].get(name)
+        if info is None:
+            continue
+        if info["kind"] == "category":
+            code = np.load(column_dir / f"{name}.codes.npy", mmap_mode="r")[row]
+            record[name] = info["categories"][code] if code >= 0 else None
+        elif info["kind"] == "text":
+            record[name] = _text_values(column_dir, name, [row])[0]
+        else:
+            record[name] = np.load(column_dir / f"{name}.npy", mmap_mode="r")[row].item()
+    return record
+
+
+def text_columns(meta):
+    return [name for name in TEXT_COLUMNS if name in meta["columns"]]
+
+
+def main():
+    df = pd.read_csv(DATA_PATH)
+    meta = write_columns(df)
+
+    kinds = pd.Series({name: info["kind"] for name, info in meta["columns"].items()})
+    print(f"✅ Column store v{meta['version']}: {meta['count']:,} records, "
+          + ", ".join(f"{n} {k}" for k, n in kinds.value_counts().items()) + " columns")
+    print(f"Saved in: {COLUMN_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,28 @@
 # dashboard.py
+import hashlib
+import inspect
+import io
+
 import streamlit as st
 import pandas as pd
-from pathlib import Path
+import matplotlib
 import matplotlib.pyplot as plt
-from sentence_transformers import SentenceTransformer
 
+import column_store
+import embedding_store
+import ann_index
+import encoder
+import knn_graph
+from facet_index import FacetIndex
+from lexical_index import BM25Index
+from search_cache import QUERY_CACHE
+from insight_table import load_insights
 from ai_similarity_search import (
     load_data as load_ai_data,
-    load_embeddings,
-    build_embeddings,
+    refresh_embeddings,
     find_similar,
     generate_ai_insight,
-    MODEL_NAME,
-    EMB_PATH
+    MODEL_NAME
 )
 
 # -------------------------------------------------
@@ -105,37 +115,78 @@ div.card:hover {
 # -------------------------------------------------
 # LOAD DATA
 # -------------------------------------------------
-DATA_PATH = Path("data/analytics/defect_reports_with_risk.csv")
+DATA_PATH = column_store.DATA_PATH
+
+# Columns each view reads from the column store (free text stays on disk)
+OVERVIEW_COLUMNS = (
+    "month", "risk_level", "system", "defect_category",
+    "root_cause_cluster", "life_hours", "trade",
+)
+INSPECTOR_COLUMNS = (
+    "case_id", "date_of_occurrence", "aircraft", "trade", "system", "part_no",
+    "defect_category", "root_cause_cluster", "risk_score", "risk_level",
+)
+
+def load_column_meta():
+    if not DATA_PATH.exists() and not column_store.column_store_exists():
+        return None
+    # One-off conversion when the pipeline predates the column store
+    # (or the CSV was regenerated without it)
+    meta_path = column_store.COLUMN_DIR / column_store.COLUMN_META
+    if not meta_path.exists() or (
+        DATA_PATH.exists() and DATA_PATH.stat().st_mtime > meta_path.stat().st_mtime
+    ):
+        column_store.write_columns(pd.read_csv(DATA_PATH))
+    return column_store.load_meta()
 
 @st.cache_data
-def load_data():
-    if not DATA_PATH.exists():
-        st.error(f"Data file not found: {DATA_PATH}")
-        return pd.DataFrame()
-        
-    df = pd.read_csv(DATA_PATH)
-
-    # Ensure month column exists for timeline plot
-    if "date_of_occurrence" in df.columns:
-        # Convert to datetime and extract YYYY-MM
-        dates = pd.to_datetime(df["date_of_occurrence"], dayfirst=True, errors="coerce")
-        df["month"] = dates.dt.to_period("M").astype(str)
-    else:
-        df["month"] = "Unknown"
+def load_data(columns, version):
+    # version keys the cache: a rebuilt store is read afresh
+    return column_store.read_columns(columns)
 
-    return df
+@st.cache_data
+def load_record(row, version):
+    meta = column_store.load_meta()
+    return column_store.read_record(row, column_store.text_columns(meta), meta=meta)
 
-df = load_data()
+column_meta = load_column_meta()
+if column_meta is None:
+    st.error(f"Data file not found: {DATA_PATH}")
+    df = pd.DataFrame()
+else:
+    df = load_data(OVERVIEW_COLUMNS, column_meta["version"])
 
 @st.cache_resource
 def load_ai_components():
     df_ai = load_ai_data()
-    if not EMB_PATH.exists():
-        embeddings, model = build_embeddings(df_ai)
-    else:
-        embeddings = load_embeddings()
-        model = SentenceTransformer(MODEL_NAME)
-    return df_ai, embeddings, model
+    model = encoder.load_encoder(MODEL_NAME)
+    # Corpus vectors always come from the reference model
+    reference = model if encoder.ENCODER_BACKEND == "torch" else None
+    embeddings, _ = refresh_embeddings(df_ai, reference)
+    manifest = embedding_store.load_manifest()
+    index = ann_index.load_index(embeddings=embeddings, manifest=manifest)
+    QUERY_CACHE.bind(manifest["version"])
+    facets = FacetIndex(df_ai)
+    lexical = BM25Index.from_df(df_ai)
+    insights = load_insights(df_ai)
+    return df_ai, embeddings, model, index, facets, lexical, insights
+
+@st.cache_resource(max_entries=1)
+def load_related_graph(graph_mtime, store_mtime):
+    # Built offline by knn_graph.py; None until the first build. The file
+    # mtimes key the cache, so a nightly rebuild is picked up on the next rerun
+    graph = knn_graph.load_graph()
+    if graph is not None and embedding_store.store_exists():
+        # A graph built for another store version may point at stale records
+        if graph.version != embedding_store.load_manifest()["version"]:
+            return None
+    return graph
+
+def related_cases(case_id, top_n=5):
+    def mtime(path):
+        return path.stat().st_mtime if path.exists() else None
+    graph = load_related_graph(mtime(knn_graph.KNN_PATH), mtime(embedding_store.MANIFEST_PATH))
+    return graph.related(case_id, top_n=top_n) if graph else []
 
 # -------------------------------------------------
 # HEADER
@@ -166,6 +217,119 @@ if not df.empty:
     kpi_card(k3, "Medium Risk", f"{(df['risk_level']=='Medium').sum():,}", "🔸")
     kpi_card(k4, "Affected Systems", f"{df['system'].nunique()}", "⚙️")
 
+# -------------------------------------------------
+# CHARTS (rendered once per data version, shared by all sessions)
+# -------------------------------------------------
+CHART_DPI = 200
+
+def style_chart(fig, ax, title, fontsize=9, pad=None, grid_axis="y"):
+    # Styling to match 'Card' look (dark background for the plot area)
+    fig.patch.set_facecolor('#1e293b') # Match card color
+    fig.patch.set_alpha(0.7)
+    ax.set_facecolor("none")
+
+    ax.set_title(title, fontsize=fontsize, color="white", pad=pad)
+    ax.tick_params(colors="#94a3b8")
+    if grid_axis:
+        ax.grid(axis=grid_axis, alpha=0.1, color="white")
+
+    for spine in ax.spines.values():
+        spine.set_color('#334155')
+
+def draw_timeline(df, fig, ax):
+    # Group by month and sort
+    monthly_counts = df.groupby("month", as_index=False, observed=True).size()
+    monthly_counts = monthly_counts.sort_values("month")
+
+    # Plot
+    monthly_counts.plot(x="month", y="size", ax=ax, marker="o", color="#38bdf8", linewidth=2)
+
+    style_chart(fig, ax, "Defect Trends Over Time", fontsize=10, pad=15, grid_axis=None)
+    ax.set_ylabel("Defect Count", color="#94a3b8")
+    ax.set_xlabel("")
+    ax.tick_params(axis='x', rotation=45, colors="#94a3b8")
+    ax.tick_params(axis='y', colors="#94a3b8")
+    ax.grid(alpha=0.1, color="white", linestyle="--")
+
+def draw_risk_levels(df, fig, ax):
+    colors = ["#22c55e", "#f59e0b", "#ef4444"] # green, orange, red
+    df["risk_level"].value_counts().reindex(["Low", "Medium", "High"]).plot(
+        kind="bar", ax=ax, color=colors, width=0.6
+    )
+    style_chart(fig, ax, "Risk Severity Distribution", fontsize=10, pad=15)
+
+def draw_systems(df, fig, ax):
+    df["system"].value_counts().head(8).plot(kind="barh", ax=ax, color="#38bdf8")
+    style_chart(fig, ax, "Top Failing Systems", grid_axis="x")
+
+def draw_categories(df, fig, ax):
+    df["defect_category"].value_counts().plot(kind="bar", ax=ax, color="#a78bfa")
+    style_chart(fig, ax, "Defect Categories")
+
+def draw_clusters(df, fig, ax):
+    df["root_cause_cluster"].value_counts().sort_index().plot(kind="bar", ax=ax, color="#f472b6")
+    style_chart(fig, ax, "Root Cause Clusters")
+
+def draw_life_hours(df, fig, ax):
+    df.groupby("system", observed=True)["life_hours"].mean().sort_values().tail(8).plot(
+        kind="barh", ax=ax, color="#22d3ee"
+    )
+    style_chart(fig, ax, "Mean Life Before Failure (Hours)", grid_axis="x")
+
+def draw_trades(df, fig, ax):
+    df["trade"].value_counts().plot(kind="pie", ax=ax, autopct="%1.1f%%",
+        colors=["#38bdf8", "#818cf8", "#c084fc", "#f472b6"])
+
+    fig.patch.set_facecolor('#1e293b')
+    fig.patch.set_alpha(0.7)
+    ax.set_facecolor("none")
+
+    ax.set_title("Defects by Trade", fontsize=9, color="white")
+    ax.set_ylabel("")
+    plt.setp(ax.texts, color="white")
+
+# name -> (figsize, draw function)
+CHARTS = {
+    "timeline": ((6, 3.5), draw_timeline),
+    "risk_levels": ((4, 3.5), draw_risk_levels),
+    "systems": ((4, 3), draw_systems),
+    "categories": ((4, 3), draw_categories),
+    "clusters": ((4, 3), draw_clusters),
+    "life_hours": ((5, 3), draw_life_hours),
+    "trades": ((5, 3), draw_trades),
+}
+
+def chart_code(name):
+    # Salt for the persisted PNGs: editing a draw_* function, style_chart or
+    # upgrading matplotlib changes it, so stale images are never served
+    digest = hashlib.sha1(matplotlib.__version__.encode("utf-8"))
+    for fn in (style_chart, CHARTS[name][1]):
+        digest.update(inspect.getsource(fn).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+CHART_CODE = {name: chart_code(name) for name in CHARTS}
+
+@st.cache_data(persist="disk", show_spinner=False)
+def render_chart(name, version, figsize, code, dpi=CHART_DPI):
+    # PNG bytes keyed by chart, data version, size and drawing code: reruns
+    # (e.g. typing a search query) and other sessions reuse them without
+    # any plotting
+    df = load_data(OVERVIEW_COLUMNS, version)
+    fig, ax = plt.subplots(figsize=figsize)
+    try:
+        CHARTS[name][1](df, fig, ax)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=dpi, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    return buf.getvalue()
+
+def show_chart(name):
+    st.image(
+        render_chart(name, column_meta["version"], CHARTS[name][0], CHART_CODE[name]),
+        use_container_width=True,
+    )
+
 # -------------------------------------------------
 # PRIMARY INSIGHTS
 # -------------------------------------------------
@@ -174,54 +338,13 @@ c1, c2 = st.columns([3, 2])
 
 with c1:
     if not df.empty and "month" in df.columns:
-        fig, ax = plt.subplots(figsize=(6, 3.5))
-        # Group by month and sort
-        monthly_counts = df.groupby("month", as_index=False).size()
-        monthly_counts = monthly_counts.sort_values("month")
-        
-        # Plot
-        monthly_counts.plot(x="month", y="size", ax=ax, marker="o", color="#38bdf8", linewidth=2)
-        
-        # Styling to match 'Card' look (dark background for the plot area)
-        fig.patch.set_facecolor('#1e293b') # Match card color
-        fig.patch.set_alpha(0.7)
-        ax.set_facecolor("none")
-        
-        ax.set_title("Defect Trends Over Time", fontsize=10, color="white", pad=15)
-        ax.set_ylabel("Defect Count", color="#94a3b8")
-        ax.set_xlabel("")
-        ax.tick_params(axis='x', rotation=45, colors="#94a3b8")
-        ax.tick_params(axis='y', colors="#94a3b8")
-        ax.grid(alpha=0.1, color="white", linestyle="--")
-        
-        for spine in ax.spines.values():
-            spine.set_color('#334155')
-            
-        st.pyplot(fig)
+        show_chart("timeline")
     else:
         st.info("Insufficient data for timeline.")
 
 with c2:
     if not df.empty:
-        fig, ax = plt.subplots(figsize=(4, 3.5))
-        colors = ["#22c55e", "#f59e0b", "#ef4444"] # green, orange, red
-        df["risk_level"].value_counts().reindex(["Low", "Medium", "High"]).plot(
-            kind="bar", ax=ax, color=colors, width=0.6
-        )
-        
-        # Styling
-        fig.patch.set_facecolor('#1e293b')
-        fig.patch.set_alpha(0.7)
-        ax.set_facecolor("none")
-        
-        ax.set_title("Risk Severity Distribution", fontsize=10, color="white", pad=15)
-        ax.tick_params(colors="#94a3b8")
-        ax.grid(axis="y", alpha=0.1, color="white")
-        
-        for spine in ax.spines.values():
-            spine.set_color('#334155')
-            
-        st.pyplot(fig)
+        show_chart("risk_levels")
 
 # -------------------------------------------------
 # SECONDARY INSIGHTS (ROW 2)
@@ -231,60 +354,15 @@ s1, s2, s3 = st.columns(3)
 
 with s1:
     if not df.empty:
-        fig, ax = plt.subplots(figsize=(4,3))
-        df["system"].value_counts().head(8).plot(kind="barh", ax=ax, color="#38bdf8")
-        
-        # Styling
-        fig.patch.set_facecolor('#1e293b')
-        fig.patch.set_alpha(0.7)
-        ax.set_facecolor("none")
-        
-        ax.set_title("Top Failing Systems", fontsize=9, color="white")
-        ax.tick_params(colors="#94a3b8")
-        ax.grid(axis="x", alpha=0.1, color="white")
-        
-        for spine in ax.spines.values():
-            spine.set_color('#334155')
-            
-        st.pyplot(fig)
+        show_chart("systems")
 
 with s2:
     if not df.empty:
-        fig, ax = plt.subplots(figsize=(4,3))
-        df["defect_category"].value_counts().plot(kind="bar", ax=ax, color="#a78bfa")
-        
-        # Styling
-        fig.patch.set_facecolor('#1e293b')
-        fig.patch.set_alpha(0.7)
-        ax.set_facecolor("none")
-        
-        ax.set_title("Defect Categories", fontsize=9, color="white")
-        ax.tick_params(colors="#94a3b8")
-        ax.grid(axis="y", alpha=0.1, color="white")
-        
-        for spine in ax.spines.values():
-            spine.set_color('#334155')
-            
-        st.pyplot(fig)
+        show_chart("categories")
 
 with s3:
     if not df.empty:
-        fig, ax = plt.subplots(figsize=(4,3))
-        df["root_cause_cluster"].value_counts().sort_index().plot(kind="bar", ax=ax, color="#f472b6")
-        
-        # Styling
-        fig.patch.set_facecolor('#1e293b')
-        fig.patch.set_alpha(0.7)
-        ax.set_facecolor("none")
-        
-        ax.set_title("Root Cause Clusters", fontsize=9, color="white")
-        ax.tick_params(colors="#94a3b8")
-        ax.grid(axis="y", alpha=0.1, color="white")
-        
-        for spine in ax.spines.values():
-            spine.set_color('#334155')
-            
-        st.pyplot(fig)
+        show_chart("clusters")
 
 # -------------------------------------------------
 # DEEP-DIVE (EXPANDERS)
@@ -294,48 +372,38 @@ with st.expander("🔍 Reliability & Maintenance Deep-Dive"):
 
     with d1:
         if not df.empty:
-            fig, ax = plt.subplots(figsize=(5,3))
-            df.groupby("system")["life_hours"].mean().sort_values().tail(8).plot(
-                kind="barh", ax=ax, color="#22d3ee"
-            )
-            
-            # Styling
-            fig.patch.set_facecolor('#1e293b')
-            fig.patch.set_alpha(0.7)
-            ax.set_facecolor("none")
-            
-            ax.set_title("Mean Life Before Failure (Hours)", fontsize=9, color="white")
-            ax.tick_params(colors="#94a3b8")
-            ax.grid(axis="x", alpha=0.1, color="white")
-            
-            for spine in ax.spines.values():
-                spine.set_color('#334155')
-                
-            st.pyplot(fig)
+            show_chart("life_hours")
 
     with d2:
         if not df.empty:
-            fig, ax = plt.subplots(figsize=(5,3))
-            df["trade"].value_counts().plot(kind="pie", ax=ax, autopct="%1.1f%%", 
-                colors=["#38bdf8", "#818cf8", "#c084fc", "#f472b6"])
-            
-            # Styling
-            fig.patch.set_facecolor('#1e293b')
-            fig.patch.set_alpha(0.7)
-            ax.set_facecolor("none")
-            
-            ax.set_title("Defects by Trade", fontsize=9, color="white")
-            ax.set_ylabel("")
-            plt.setp(ax.texts, color="white")
-            
-            st.pyplot(fig)
+            show_chart("trades")
 
 # -------------------------------------------------
 # DATA INSPECTOR (PREVIEW)
 # -------------------------------------------------
 with st.expander("🔎 Data Inspector & Previous Previews (Raw Data)", expanded=False):
     st.markdown("Explore the underlying dataset used for these metrics.")
-    st.dataframe(df, use_container_width=True)
+    if column_meta is not None:
+        inspector = load_data(INSPECTOR_COLUMNS, column_meta["version"])
+        st.dataframe(inspector, use_container_width=True)
+
+        # Full report text is read for the chosen record only
+        row = st.selectbox(
+            "Open full report",
+            inspector.index,
+            index=None,
+            format_func=lambda r: inspector.at[r, "case_id"],
+            placeholder="Choose a case ID...",
+        )
+        if row is not None:
+            record = load_record(int(row), column_meta["version"])
+            for name in column_store.text_columns(column_meta):
+                if record.get(name):
+                    st.markdown(f"**{name.replace('_', ' ').title()}:** {record[name]}")
+
+            related = related_cases(inspector.at[row, "case_id"])
+            if related:
+                st.caption("Related cases: " + ", ".join(f"{cid} ({sc})" for cid, sc in related))
 
 # -------------------------------------------------
 # AI SIMILARITY SEARCH
@@ -365,13 +433,36 @@ with col_search:
         placeholder="e.g. 'Cracks found in the fuselage near the wing root...'"
     )
 
+# Optional metadata filters (applied before scoring)
+f1, f2, f3, f4 = st.columns(4)
+with f1:
+    filter_system = st.multiselect("System", sorted(df["system"].dropna().unique()) if not df.empty else [])
+with f2:
+    filter_trade = st.multiselect("Trade", sorted(df["trade"].dropna().unique()) if not df.empty else [])
+with f3:
+    filter_risk = st.multiselect("Risk Level", ["High", "Medium", "Low"])
+with f4:
+    filter_dates = st.date_input("Occurred between", value=(), format="DD/MM/YYYY")
+
+search_filters = {
+    "system": filter_system,
+    "trade": filter_trade,
+    "risk_level": filter_risk,
+}
+if len(filter_dates) == 2:
+    search_filters["date_from"], search_filters["date_to"] = filter_dates
+
+hybrid = st.toggle("Match part numbers & exact terms (hybrid keyword + semantic search)", value=False)
+
 if st.button("Find Similar Defects", type="primary"):
     if not query:
         st.warning("Please enter a description.")
     else:
         with st.spinner("Searching vector database..."):
-            df_ai, embeddings, model = load_ai_components()
-            results = find_similar(query, df_ai, embeddings, model)
+            df_ai, embeddings, model, index, facets, lexical, insights = load_ai_components()
+            results = find_similar(query, df_ai, embeddings, model, index=index, cache=QUERY_CACHE,
+                                   filters=search_filters, facets=facets,
+                                   lexical=lexical if hybrid else None)
 
         if results:
             st.markdown(f"### Found {len(results)} Similar Cases")
@@ -394,12 +485,29 @@ if st.button("Find Similar Defects", type="primary"):
                         st.markdown(f"**Preventive Action:**\n{r['preventive_action']}")
                         st.caption(f"Similarity Band: :{band_color}[{r['similarity_band']}]")
 
-            ai = generate_ai_insight(results)
+                    related = related_cases(r["case_id"])
+                    if related:
+                        st.caption("Related cases: " + ", ".join(f"{cid} ({sc})" for cid, sc in related))
+
+            ai = generate_ai_insight(results, insights)
             if ai:
                 st.markdown("### 🧠 AI Insight Summary")
                 st.info(f"**Predicted Root Cause:** {ai['predicted_root_cause']} (Confidence: {ai['confidence']})")
                 st.markdown("**Recommended Preventive Strategies:**")
                 for a in ai["recommended_preventive_actions"]:
                     st.markdown(f"- {a}")
+
+                history = ai.get("history")
+                if history:
+                    st.markdown("**Recommended Corrective Actions:**")
+                    for a in ai["recommended_corrective_actions"]:
+                        st.markdown(f"- {a}")
+                    scope = "all systems" if history["system"] == "*" else history["system"]
+                    st.caption(f"Across {history['reports']} past reports ({scope}), "
+                               f"{history['months_active']} months active "
+                               f"({history['first_seen']} to {history['last_seen']})")
+                    if history["recurring_parts"]:
+                        st.caption("Recurring parts: " + ", ".join(
+                            f"{part} ({n})" for part, n in history["recurring_parts"]))
         else:
             st.info("No similar defects found.")
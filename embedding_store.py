@@ -0,0 +1,313 @@
+# embedding_store.py
+"""
+Shared on-disk store for defect text embeddings.
+
+Layout:
+- defect_embeddings.npy  : L2-normalized float32 matrix (one row per record)
+- defect_embeddings.json : manifest (model name, dimension, row -> case_id,
+                           per-row text hashes, store version)
+
+Embeddings are written once by ai_similarity_search and read by every
+downstream stage (search, clustering) through a read-only memory map,
+so no stage re-encodes text or holds a private copy in memory, and every
+process that maps the file shares the same pages.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:                 # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+from pathlib import Path
+
+EMB_MATRIX_PATH = Path("data/analytics/defect_embeddings.npy")
+MANIFEST_PATH = Path("data/analytics/defect_embeddings.json")
+LOCK_PATH = Path("data/analytics/defect_embeddings.lock")
+
+COPY_BLOCK = 65_536
+# Every matrix write ends with a unique stamp (after the array data, where
+# np.load never looks) that the manifest repeats
+STAMP_PREFIX = b"#store:"
+STAMP_LEN = len(STAMP_PREFIX) + 32
+LOAD_RETRIES = 20
+LOAD_RETRY_WAIT = 0.05
+
+
+def text_hash(text):
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()[:16]
+
+
+def normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(embeddings / norms)
+
+
+def store_version(model_name, text_hashes):
+    digest = hashlib.sha1(model_name.encode("utf-8"))
+    for h in text_hashes:
+        digest.update(h.encode("ascii"))
+    return digest.hexdigest()[:12]
+
+
+def _temp_path(path):
+    # Unique per writer (threads and processes alike), in the target's
+    # directory so the final rename stays on one filesystem
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    os.close(fd)
+    return Path(tmp)
+
+
+def _atomic_write(path, write):
+    # Write to a temp file in the same directory, then rename over the target
+    path = Path(path)
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+@contextmanager
+def store_lock(lock_path=LOCK_PATH):
+    """
+    Exclusive lock shared by every process (and thread) using the store:
+    held around a refresh so that callers noticing the same change rebuild
+    it once, the others finding it up to date.
+    """
+    lock_path = Path(lock_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:     # LK_LOCK gives up after ~10 s; keep waiting
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _stamp(path):
+    token = uuid.uuid4().hex
+    with open(path, "ab") as f:
+        f.write(STAMP_PREFIX + token.encode("ascii"))
+    return token
+
+
+def read_stamp(matrix_path):
+    """
+    The stamp a matrix file was written with, or None (e.g. a store written
+    before stamps existed).
+    """
+    with open(matrix_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < STAMP_LEN:
+            return None
+        f.seek(-STAMP_LEN, os.SEEK_END)
+        tail = f.read()
+    return tail[len(STAMP_PREFIX):].decode("ascii") if tail.startswith(STAMP_PREFIX) else None
+
+
+def _manifest(case_ids, text_hashes, model_name, embeddings):
+    return {
+        "version": store_version(model_name, text_hashes),
+        "model_name": model_name,
+        "dim": int(embeddings.shape[1]),
+        "count": len(case_ids),
+        "dtype": "float32",
+        "normalized": True,
+        "matrix_stamp": None,                # set by _commit
+        "created_at": datetime.now().isoformat(),
+        "case_ids": case_ids,
+        "text_hashes": text_hashes,
+    }
+
+
+def _commit(matrix_tmp, matrix_path, manifest, manifest_path):
+    """
+    Swap in a fully written matrix and its manifest. Both are complete on
+    disk before either rename; the manifest goes last and carries the new
+    matrix stamp, so a reader between the two renames sees a mismatch
+    (and retries in load_store) rather than new vectors under old ids.
+    """
+    manifest["matrix_stamp"] = _stamp(matrix_tmp)
+    manifest_path = Path(manifest_path)
+    manifest_tmp = _temp_path(manifest_path)
+    manifest_tmp.write_bytes(json.dumps(manifest).encode("utf-8"))
+    os.replace(matrix_tmp, matrix_path)
+    os.replace(manifest_tmp, manifest_path)
+    return manifest
+
+
+def _write_manifest(case_ids, text_hashes, model_name, embeddings, manifest_path):
+    # For a matrix already in place (e.g. written directly by a benchmark)
+    manifest = _manifest(case_ids, text_hashes, model_name, embeddings)
+    _atomic_write(Path(manifest_path), lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+    return manifest
+
+
+def save_store(embeddings, case_ids, texts, model_name,
+               matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+    """
+    Write the matrix and its manifest. The manifest is written last, so its
+    presence means the store is complete (see _commit).
+    """
+    embeddings = normalize(embeddings)
+    case_ids = [str(c) for c in case_ids]
+    text_hashes = [text_hash(t) for t in texts]
+
+    if not (len(embeddings) == len(case_ids) == len(text_hashes)):
+        raise ValueError("embeddings, case_ids and texts must have the same length")
+
+    matrix_path = Path(matrix_path)
+    tmp = _temp_path(matrix_path)
+    with open(tmp, "wb") as f:
+        np.save(f, embeddings)
+
+    manifest = _manifest(case_ids, text_hashes, model_name, embeddings)
+    return _commit(tmp, matrix_path, manifest, manifest_path)
+
+
+def update_store(old_embeddings, source_rows, new_rows, new_embeddings,
+                 case_ids, text_hashes, model_name,
+                 matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+    """
+    Write a refreshed store without re-encoding unchanged rows.
+
+    source_rows[i] is the row in old_embeddings to carry over for output
+    row i (-1 if it must come from new_embeddings); new_rows lists the
+    output rows that new_embeddings fills, in order. Readers may have the
+    old file mapped, so it is never modified in place: rows are copied into
+    a temp file in blocks and swapped in with an atomic rename.
+    """
+    matrix_path = Path(matrix_path)
+    source_rows = np.asarray(source_rows)
+    n, dim = len(source_rows), old_embeddings.shape[1]
+
+    tmp = _temp_path(matrix_path)
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=(n, dim))
+
+    for start in range(0, n, COPY_BLOCK):
+        src = source_rows[start:start + COPY_BLOCK]
+        keep = np.flatnonzero(src >= 0)
+        out[start + keep] = old_embeddings[src[keep]]
+
+    if len(new_rows):
+        out[np.asarray(new_rows)] = normalize(new_embeddings)
+
+    out.flush()
+    manifest = _manifest([str(c) for c in case_ids], list(text_hashes), model_name, out)
+    del out
+
+    return _commit(tmp, matrix_path, manifest, manifest_path)
+
+
+class StoreWriter:
+    """
+    Streamed store build: embeddings are written into a memory-mapped temp
+    file as they arrive (rows in any order), so the full matrix is never
+    held in memory, and the store is swapped in atomically on close.
+    """
+
+    def __init__(self, n, dim, matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+        self.matrix_path = Path(matrix_path)
+        self.manifest_path = manifest_path
+        self.tmp = _temp_path(self.matrix_path)
+        self.out = np.lib.format.open_memmap(self.tmp, mode="w+", dtype=np.float32, shape=(n, dim))
+        self.written = np.zeros(n, dtype=bool)
+
+    def write(self, rows, embeddings):
+        rows = np.asarray(rows)
+        self.out[rows] = normalize(embeddings)
+        self.written[rows] = True
+
+    def close(self, case_ids, texts, model_name):
+        missing = int((~self.written).sum())
+        if missing:
+            self.abort()
+            raise ValueError(f"{missing} rows were never written; store left unchanged")
+
+        self.out.flush()
+        manifest = _manifest(
+            [str(c) for c in case_ids], [text_hash(t) for t in texts], model_name, self.out
+        )
+        del self.out
+
+        return _commit(self.tmp, self.matrix_path, manifest, self.manifest_path)
+
+    def abort(self):
+        del self.out
+        self.tmp.unlink(missing_ok=True)
+
+
+def store_exists(matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+    return Path(matrix_path).exists() and Path(manifest_path).exists()
+
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    return json.loads(Path(manifest_path).read_text(encoding="utf-8"))
+
+
+def load_store(matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+    """
+    Zero-copy load: pages are mapped from disk on first access and shared
+    between processes that open the same file.
+    Returns (embeddings, manifest).
+    """
+    if not store_exists(matrix_path, manifest_path):
+        raise FileNotFoundError(
+            f"Embedding store not found: {matrix_path} "
+            "(run ai_similarity_search.py to build it)"
+        )
+
+    # A writer swaps the matrix, then the manifest: a mismatch seen in
+    # between clears once the manifest lands
+    for _ in range(LOAD_RETRIES):
+        manifest = load_manifest(manifest_path)
+        stamp = manifest.get("matrix_stamp")
+        before = read_stamp(matrix_path) if stamp else None
+        embeddings = np.load(matrix_path, mmap_mode="r")
+
+        # Same stamp before and after mapping: the mapped file is the one
+        # the manifest describes (stamps are never reused)
+        consistent = embeddings.shape == (manifest["count"], manifest["dim"]) and (
+            stamp is None or before == stamp == read_stamp(matrix_path)
+        )
+        if consistent:
+            return embeddings, manifest
+        time.sleep(LOAD_RETRY_WAIT)
+
+    raise ValueError(
+        f"Embedding store {matrix_path} (shape {embeddings.shape}) does not match its manifest "
+        f"({manifest['count']}, {manifest['dim']}, stamp {manifest.get('matrix_stamp')})"
+    )
+
+
+def load_embeddings(matrix_path=EMB_MATRIX_PATH, manifest_path=MANIFEST_PATH):
+    return load_store(matrix_path, manifest_path)[0]
@@ -0,0 +1,233 @@
+# encoder.py
+"""
+Query encoder backends for similar-defect search (CPU).
+
+- torch     : reference SentenceTransformer (default)
+- quantized : same model with its Linear layers dynamically quantized to int8;
+              the quantized module is saved under ENCODER_DIR, so later
+              processes load the int8 copy instead of the float32
+              checkpoint and don't re-quantize it
+- onnx      : ONNX Runtime export (needs sentence-transformers[onnx]); the
+              export is saved under ENCODER_DIR so later processes load it
+              directly instead of the PyTorch checkpoint
+
+Only queries go through a fast backend; the stored corpus embeddings always
+come from the reference model. A fast backend is only used once it has been
+verified against the reference (python encoder.py): every sample embedding
+must reach ENCODER_TOLERANCE cosine similarity with the reference one.
+Unverified or failing backends fall back to the reference model.
+
+python encoder.py also sweeps PyTorch intra-op thread counts per backend
+and records the fastest in the report; load_encoder applies it unless
+ENCODER_THREADS is set.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+from pathlib import Path
+from sentence_transformers import SentenceTransformer
+
+import embedding_store
+
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "torch")
+ENCODER_THREADS = int(os.environ.get("ENCODER_THREADS", 0))      # 0 = tuned count from the report
+ENCODER_TOLERANCE = float(os.environ.get("ENCODER_TOLERANCE", 0.99))
+
+ENCODER_DIR = Path("data/analytics/models/encoder")
+REPORT_PATH = ENCODER_DIR / "encoder_report.json"
+
+BACKENDS = ["torch", "quantized", "onnx"]
+VERIFY_SAMPLE = 200
+LATENCY_QUERIES = 50
+
+
+def set_threads(n=ENCODER_THREADS):
+    """
+    Intra-op threads for PyTorch. Single short queries gain little from
+    many threads and contend with other processes on the box, so a small
+    fixed count usually lowers per-query latency (0 keeps the default).
+    """
+    if n:
+        import torch
+        torch.set_num_threads(n)
+
+
+def thread_candidates():
+    # 1, 2, 4, ... up to the core count
+    cores = os.cpu_count() or 1
+    return sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+
+
+def quantized_path(model_name):
+    return ENCODER_DIR / f"{model_name}-quantized.pt"
+
+
+def _load_backend(model_name, backend, threads=ENCODER_THREADS):
+    set_threads(threads)
+
+    if backend == "torch":
+        return SentenceTransformer(model_name, device="cpu")
+
+    if backend == "quantized":
+        import torch
+        path = quantized_path(model_name)
+        if path.exists():
+            return torch.load(path, weights_only=False)
+        model = SentenceTransformer(model_name, device="cpu")
+        # int8 weights, activations quantized on the fly; no calibration needed
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        ENCODER_DIR.mkdir(parents=True, exist_ok=True)
+        embedding_store._atomic_write(path, lambda f: torch.save(model, f))
+        return model
+
+    if backend == "onnx":
+        onnx_dir = ENCODER_DIR / f"{model_name}-onnx"
+        if onnx_dir.exists():
+            return SentenceTransformer(str(onnx_dir), backend="onnx", device="cpu")
+        model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+        model.save_pretrained(str(onnx_dir))
+        return model
+
+    raise ValueError(f"Unknown encoder backend '{backend}' (choose from {BACKENDS})")
+
+
+def load_report():
+    if not REPORT_PATH.exists():
+        return {}
+    return json.loads(REPORT_PATH.read_text(encoding="utf-8"))
+
+
+def load_encoder(model_name, backend=ENCODER_BACKEND):
+    """
+    Encoder for queries. Fast backends must have passed verification for
+    this model; otherwise the reference model is returned.
+    """
+    report = load_report()
+    if report.get("model_name") != model_name:
+        report = {}
+
+    if backend != "torch":
+        check = report.get("backends", {}).get(backend, {})
+        if not check.get("passed"):
+            print(f"⚠️ {backend} encoder not verified for {model_name} "
+                  "(run python encoder.py); using the reference model")
+            backend = "torch"
+
+    def threads(backend):
+        return ENCODER_THREADS or report.get("backends", {}).get(backend, {}).get("threads", 0)
+
+    try:
+        return _load_backend(model_name, backend, threads(backend))
+    except ImportError as e:
+        print(f"⚠️ {backend} encoder unavailable ({e}); using the reference model")
+        return _load_backend(model_name, "torch", threads("torch"))
+
+
+def verify_encoder(model, reference, texts, tolerance=ENCODER_TOLERANCE):
+    """
+    Compare a backend's embeddings with the reference model's on the same
+    texts (both L2-normalized, so the dot product is the cosine).
+    """
+    fast = np.asarray(model.encode(texts, normalize_embeddings=True))
+    ref = np.asarray(reference.encode(texts, normalize_embeddings=True))
+    cosine = np.sum(fast * ref, axis=1)
+    return {
+        "min_cosine": round(float(cosine.min()), 5),
+        "mean_cosine": round(float(cosine.mean()), 5),
+        "tolerance": tolerance,
+        "passed": bool(cosine.min() >= tolerance),
+    }
+
+
+def query_latency_ms(model, queries):
+    # Single-query encodes, as the CLI and dashboard issue them
+    model.encode(queries[:1], normalize_embeddings=True)       # warm-up
+    times = []
+    for q in queries:
+        start = time.perf_counter()
+        model.encode([q], normalize_embeddings=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return round(float(np.median(times)), 2), round(float(np.percentile(times, 99)), 2)
+
+
+def tune_threads(model, queries):
+    """
+    Query latency at each candidate intra-op thread count. Returns
+    (fastest count, its p50, its p99) and leaves that count set.
+    """
+    latency = {}
+    for n in thread_candidates():
+        set_threads(n)
+        latency[n] = query_latency_ms(model, queries)
+    best = min(latency, key=lambda n: latency[n][0])
+    set_threads(best)
+    print("   threads: " + ", ".join(f"{n} -> {p50:.2f} ms" for n, (p50, _) in latency.items()))
+    return best, *latency[best]
+
+
+def main():
+    from ai_similarity_search import load_data, MODEL_NAME
+
+    df = load_data()
+    texts = df["combined_text"].sample(min(VERIFY_SAMPLE, len(df)), random_state=42).tolist()
+    queries = df["defect_observed"].dropna().sample(
+        min(LATENCY_QUERIES, len(df)), random_state=0
+    ).tolist()
+
+    report = {
+        "model_name": MODEL_NAME,
+        "cpu_count": os.cpu_count(),
+        "created_at": datetime.now().isoformat(),
+        "backends": {},
+    }
+    reference = None
+
+    for backend in BACKENDS:
+        try:
+            # First load may download, export or quantize and save the model
+            _load_backend(MODEL_NAME, backend)
+        except ImportError as e:
+            print(f"⚠️ Skipping {backend}: {e}")
+            continue
+
+        # Cold start as later processes see it, with any saved copy in place
+        start = time.perf_counter()
+        model = _load_backend(MODEL_NAME, backend)
+        load_seconds = time.perf_counter() - start
+
+        if reference is None:
+            reference = model
+
+        print(f"{backend}:")
+        if backend == "onnx":
+            threads = 0                 # ONNX Runtime sizes its own thread pool
+            p50, p99 = query_latency_ms(model, queries)
+        else:
+            threads, p50, p99 = tune_threads(model, queries)
+        check = verify_encoder(model, reference, texts)
+        report["backends"][backend] = {
+            "load_seconds": round(load_seconds, 2),
+            "threads": threads,
+            "query_p50_ms": p50,
+            "query_p99_ms": p99,
+            **check,
+        }
+
+        status = "✅" if check["passed"] else "❌"
+        print(f"{status} {backend:<9} load {load_seconds:5.2f}s | query p50 {p50:6.2f} ms, "
+              f"p99 {p99:6.2f} ms at {threads or 'default'} threads | "
+              f"min cosine {check['min_cosine']:.4f}")
+
+    ENCODER_DIR.mkdir(parents=True, exist_ok=True)
+    REPORT_PATH.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Report saved to: {REPORT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# facet_index.py
+"""
+Precomputed row bitmaps for metadata-filtered similar-defect search.
+
+For every value of each facet column (system, trade, risk_level) the rows
+holding that value are kept as a packed bitmap (1 bit per row), and the
+occurrence dates as a day array. A filter is resolved to a row set with a
+few bitwise ORs / ANDs before any vector is scored, so a filtered search
+only scores the rows it can return.
+"""
+
+import numpy as np
+import pandas as pd
+
+FACET_COLUMNS = ["system", "trade", "risk_level"]
+DATE_COLUMN = "date_of_occurrence"
+DATE_FILTERS = ("date_from", "date_to")
+
+
+def filters_key(filters):
+    """
+    Hashable, order-independent form of a filter dict (for cache keys).
+    """
+    if not filters:
+        return ()
+    key = []
+    for name, value in sorted(filters.items()):
+        if value is None or (isinstance(value, (list, tuple, set)) and not value):
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = tuple(sorted(str(v) for v in value))
+        else:
+            value = str(value)
+        key.append((name, value))
+    return tuple(key)
+
+
+class FacetIndex:
+    def __init__(self, df, facet_columns=FACET_COLUMNS, date_column=DATE_COLUMN):
+        self.n = len(df)
+        self.bitmaps = {}
+
+        for col in facet_columns:
+            if col not in df.columns:
+                continue
+            codes, values = pd.factorize(df[col].astype("string"))
+            self.bitmaps[col] = {
+                str(value): np.packbits(codes == i)
+                for i, value in enumerate(values)
+            }
+
+        self.dates = None
+        if date_column in df.columns:
+            dates = pd.to_datetime(df[date_column], dayfirst=True, errors="coerce")
+            self.dates = dates.values.astype("datetime64[D]")
+
+    def values(self, col):
+        return sorted(self.bitmaps.get(col, {}))
+
+    def _facet_bits(self, col, value):
+        if col not in self.bitmaps:
+            raise ValueError(f"Unknown filter '{col}' (available: {sorted(self.bitmaps) + list(DATE_FILTERS)})")
+
+        wanted = value if isinstance(value, (list, tuple, set)) else [value]
+        bits = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+        for v in wanted:
+            # A value that never occurs simply matches no rows
+            bitmap = self.bitmaps[col].get(str(v))
+            if bitmap is not None:
+                bits |= bitmap
+        return bits
+
+    def select(self, filters):
+        """
+        Rows matching every filter, as sorted row positions; None when no
+        filter is set. Facet filters take one value or a list of values
+        (any of them matches); date_from / date_to bound date_of_occurrence
+        inclusively and exclude rows with no parseable date.
+        """
+        filters = {k: v for k, v in (filters or {}).items() if v not in (None, [], ())}
+        if not filters:
+            return None
+
+        bits = np.full((self.n + 7) // 8, 0xFF, dtype=np.uint8)
+        for col, value in filters.items():
+            if col not in DATE_FILTERS:
+                bits &= self._facet_bits(col, value)
+
+        mask = np.unpackbits(bits, count=self.n).astype(bool)
+
+        if any(k in filters for k in DATE_FILTERS):
+            if self.dates is None:
+                raise ValueError(f"Date filters need a '{DATE_COLUMN}' column")
+            if "date_from" in filters:
+                mask &= self.dates >= np.datetime64(pd.Timestamp(filters["date_from"]).date(), "D")
+            if "date_to" in filters:
+                mask &= self.dates <= np.datetime64(pd.Timestamp(filters["date_to"]).date(), "D")
+
+        return np.flatnonzero(mask)
@@ -0,0 +1,191 @@
+# insight_table.py
+"""
+Precomputed insight statistics for generate_ai_insight.
+
+For every (root_cause_cluster, system) pair, and for every cluster across
+all systems, the table keeps running counts over the whole defect history:
+- preventive and corrective actions (frequency-ranked on lookup)
+- reports, recurring part numbers and active months (recurrence)
+
+Everything is a count, so the table refreshes incrementally: each record's
+contribution is remembered by case_id, and on refresh only new, changed
+or deleted records are added or subtracted. Looking up an insight costs a
+dict access and a rank of a few distinct actions, however many reports
+the history holds.
+
+Run: python insight_table.py  (after clustering; refreshes the saved table)
+"""
+
+import time
+from collections import Counter, defaultdict
+
+import joblib
+import pandas as pd
+from pathlib import Path
+
+DATA_PATH = Path("data/analytics/defect_reports_with_clusters.csv")
+INSIGHT_PATH = Path("data/analytics/insight_table.joblib")
+
+ALL_SYSTEMS = "*"
+TOP_ACTIONS = 5
+TOP_PARTS = 5
+
+RECORD_COLS = [
+    "case_id", "root_cause_cluster", "system", "preventive_action",
+    "corrective_action", "part_no", "date_of_occurrence",
+]
+
+
+def _empty_group():
+    return {
+        "reports": 0,
+        "preventive": Counter(),
+        "corrective": Counter(),
+        "parts": Counter(),
+        "months": Counter(),
+    }
+
+
+def _clean(value):
+    return None if pd.isna(value) or str(value).strip() == "" else str(value).strip()
+
+
+def record_contributions(df):
+    """
+    case_id -> (cluster, system, preventive, corrective, part_no, month):
+    everything one record adds to the table.
+    """
+    df = df[[c for c in RECORD_COLS if c in df.columns]].copy()
+    df = df[df["root_cause_cluster"].notna()]
+
+    if "date_of_occurrence" in df.columns:
+        months = pd.to_datetime(df["date_of_occurrence"], dayfirst=True, errors="coerce")
+        df["month"] = months.dt.strftime("%Y-%m")
+    else:
+        df["month"] = None
+
+    return {
+        str(r.case_id): (
+            int(r.root_cause_cluster),
+            _clean(getattr(r, "system", None)),
+            _clean(getattr(r, "preventive_action", None)),
+            _clean(getattr(r, "corrective_action", None)),
+            _clean(getattr(r, "part_no", None)),
+            _clean(r.month),
+        )
+        for r in df.itertuples(index=False)
+    }
+
+
+class InsightTable:
+    def __init__(self):
+        self.records = {}
+        self.groups = defaultdict(_empty_group)
+
+    def _apply(self, contribution, sign):
+        cluster, system, preventive, corrective, part_no, month = contribution
+        keys = [(cluster, ALL_SYSTEMS)] + ([(cluster, system)] if system is not None else [])
+        for key in keys:
+            group = self.groups[key]
+            group["reports"] += sign
+            for counter, value in (
+                (group["preventive"], preventive),
+                (group["corrective"], corrective),
+                (group["parts"], part_no),
+                (group["months"], month),
+            ):
+                if value is not None:
+                    counter[value] += sign
+                    if counter[value] <= 0:
+                        del counter[value]
+            if group["reports"] <= 0:
+                del self.groups[key]
+
+    def refresh(self, df):
+        """
+        Bring the counts in line with df. Returns (added, removed) record
+        counts; a changed record counts as both.
+        """
+        current = record_contributions(df)
+
+        removed = [cid for cid, old in self.records.items() if current.get(cid) != old]
+        added = [cid for cid, new in current.items() if self.records.get(cid) != new]
+
+        for cid in removed:
+            self._apply(self.records.pop(cid), -1)
+        for cid in added:
+            self._apply(current[cid], +1)
+            self.records[cid] = current[cid]
+
+        return len(added), len(removed)
+
+    def lookup(self, cluster, system=None):
+        """
+        Whole-history stats for the cluster within the system, or across all
+        systems when the system is unknown or has no history for it.
+        """
+        if cluster is None:
+            return None
+        key = (int(cluster), system) if system is not None else None
+        if key not in self.groups:
+            key = (int(cluster), ALL_SYSTEMS)
+        group = self.groups.get(key)
+        if group is None:
+            return None
+
+        months = sorted(group["months"])
+        return {
+            "cluster": key[0],
+            "system": key[1],
+            "reports": group["reports"],
+            "preventive_actions": group["preventive"].most_common(TOP_ACTIONS),
+            "corrective_actions": group["corrective"].most_common(TOP_ACTIONS),
+            "recurring_parts": [
+                (part, n) for part, n in group["parts"].most_common(TOP_PARTS) if n > 1
+            ],
+            "months_active": len(months),
+            "first_seen": months[0] if months else None,
+            "last_seen": months[-1] if months else None,
+        }
+
+    def save(self, path=INSIGHT_PATH):
+        joblib.dump({"records": self.records, "groups": dict(self.groups)}, path)
+
+    @classmethod
+    def load(cls, path=INSIGHT_PATH):
+        data = joblib.load(path)
+        table = cls()
+        table.records = data["records"]
+        table.groups.update(data["groups"])
+        return table
+
+
+def load_insights(df=None, path=INSIGHT_PATH):
+    """
+    Saved table (refreshed against df when given, and re-saved if that
+    changed anything); built from scratch when none is saved yet.
+    """
+    table = InsightTable.load(path) if Path(path).exists() else InsightTable()
+    if df is not None:
+        added, removed = table.refresh(df)
+        if added or removed:
+            table.save(path)
+    return table
+
+
+def main():
+    df = pd.read_csv(DATA_PATH)
+
+    start = time.perf_counter()
+    table = InsightTable.load() if INSIGHT_PATH.exists() else InsightTable()
+    added, removed = table.refresh(df)
+    table.save()
+
+    n_groups = sum(1 for _, system in table.groups if system != ALL_SYSTEMS)
+    print(f"✅ Insight table: {len(table.records):,} records, {n_groups:,} cluster/system groups "
+          f"({added:,} added, {removed:,} removed in {time.perf_counter() - start:.2f}s)")
+    print(f"Saved to: {INSIGHT_PATH}")
+
+
+if __name__ == "__main__":
+    main()
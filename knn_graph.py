@@ -0,0 +1,218 @@
+# knn_graph.py
+"""
+D2e: Precomputed "Related Defects" (k-nearest-neighbor graph)
+
+Offline job that stores, for every record in the embedding store, its
+KNN_K most similar other records and their similarity scores. Viewing a
+case then needs no encoding or scoring: related defects are one dict
+lookup and one row slice.
+
+The graph is updated incrementally against the current store:
+- new or re-worded records get a fresh neighbor search;
+- records whose neighbor list mentions a deleted or re-worded record are
+  searched again (their list may have a hole);
+- every other record keeps its list, merged with scores against the new
+  records only, so it picks up a new record that is now closer.
+
+Run nightly after the embedding refresh: python knn_graph.py
+"""
+
+import os
+import time
+
+import numpy as np
+from pathlib import Path
+
+import ann_index
+import embedding_store
+
+KNN_PATH = Path("data/analytics/defect_knn.npz")
+
+KNN_K = int(os.environ.get("KNN_K", 10))
+GRAPH_BATCH = 8192
+# Past this share of changed records a full rebuild is cheaper than merging
+REBUILD_FRACTION = 0.5
+
+
+class KNNGraph:
+    def __init__(self, neighbors, scores, case_ids, text_hashes, version):
+        self.neighbors = neighbors          # (n, k) row ids into case_ids, -1 = none
+        self.scores = scores                # (n, k) cosine similarity, descending
+        self.case_ids = list(case_ids)
+        self.text_hashes = list(text_hashes)
+        self.version = version
+        self.k = neighbors.shape[1]
+        self.rows = {cid: i for i, cid in enumerate(self.case_ids)}
+
+    def related(self, case_id, top_n=None, min_score=None):
+        """
+        [(case_id, score), ...] for the record's nearest neighbors, best
+        first; empty for an unknown case_id.
+        """
+        row = self.rows.get(str(case_id))
+        if row is None:
+            return []
+
+        nbrs, scores = self.neighbors[row, :top_n], self.scores[row, :top_n]
+        return [
+            (self.case_ids[j], round(float(s), 3))
+            for j, s in zip(nbrs, scores)
+            if j >= 0 and (min_score is None or s >= min_score)
+        ]
+
+    def save(self, path=KNN_PATH):
+        # Temp file + rename: the dashboard may be loading the current graph
+        embedding_store._atomic_write(Path(path), lambda f: np.savez(
+            f,
+            neighbors=self.neighbors,
+            scores=self.scores,
+            case_ids=np.asarray(self.case_ids),
+            text_hashes=np.asarray(self.text_hashes),
+            version=self.version,
+        ))
+
+    @classmethod
+    def load(cls, path=KNN_PATH):
+        data = np.load(path)
+        return cls(data["neighbors"], data["scores"], data["case_ids"].tolist(),
+                   data["text_hashes"].tolist(), str(data["version"]))
+
+
+def search_neighbors(index, embeddings, rows, k):
+    """
+    Top-k neighbors of each row, excluding the row itself.
+    Returns (neighbors, scores), padded with -1 / -inf.
+    """
+    rows = np.asarray(rows)
+    neighbors = np.full((len(rows), k), -1, dtype=np.int32)
+    scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+
+    for start in range(0, len(rows), GRAPH_BATCH):
+        batch = rows[start:start + GRAPH_BATCH]
+        top_scores, top_idx = index.search(np.asarray(embeddings[batch]), k + 1)
+
+        # Drop the query row itself (not always first under ties / ANN)
+        valid = (top_idx >= 0) & (top_idx != batch[:, None])
+        order = np.argsort(~valid, axis=1, kind="stable")[:, :k]
+        found = order.shape[1]
+        idx = np.take_along_axis(top_idx, order, axis=1)
+        sc = np.take_along_axis(top_scores, order, axis=1)
+        ok = np.take_along_axis(valid, order, axis=1)
+
+        neighbors[start:start + len(batch), :found] = np.where(ok, idx, -1)
+        scores[start:start + len(batch), :found] = np.where(ok, sc, -np.inf)
+
+    return neighbors, scores
+
+
+def merge_candidates(neighbors, scores, rows, embeddings, candidates):
+    """
+    Merge exact scores against candidate rows into the existing lists of
+    rows (candidates must not include rows themselves).
+    """
+    k = neighbors.shape[1]
+    cand_vectors = np.asarray(embeddings[candidates])
+
+    for start in range(0, len(rows), GRAPH_BATCH):
+        block = rows[start:start + GRAPH_BATCH]
+        new_scores = np.asarray(embeddings[block]) @ cand_vectors.T
+
+        all_scores = np.hstack([scores[block], new_scores])
+        all_ids = np.hstack([neighbors[block], np.broadcast_to(candidates, new_scores.shape)])
+        top_scores, top = ann_index.top_k_rows(all_scores, k)
+
+        neighbors[block] = np.take_along_axis(all_ids, top, axis=1)
+        scores[block] = top_scores
+
+
+def build_graph(embeddings, manifest, k=KNN_K, index=None):
+    index = index or ann_index.ExactIndex(embeddings)
+    neighbors, scores = search_neighbors(index, embeddings, np.arange(len(embeddings)), k)
+    return KNNGraph(neighbors, scores, manifest["case_ids"], manifest["text_hashes"],
+                    manifest["version"])
+
+
+def update_graph(graph, embeddings, manifest, k=KNN_K, index=None):
+    """
+    Bring a saved graph in line with the current store. Returns
+    (graph, n_searched) where n_searched counts rows given a fresh search.
+    """
+    n = len(embeddings)
+    if graph.k != k:
+        return build_graph(embeddings, manifest, k, index), n
+
+    case_ids, hashes = manifest["case_ids"], manifest["text_hashes"]
+
+    # Old row -> new row for records that still exist with the same text
+    old_to_new = np.full(len(graph.case_ids), -1, dtype=np.int64)
+    new_rows = {cid: i for i, cid in enumerate(case_ids)}
+    for old_row, (cid, h) in enumerate(zip(graph.case_ids, graph.text_hashes)):
+        new_row = new_rows.get(cid)
+        if new_row is not None and hashes[new_row] == h:
+            old_to_new[old_row] = new_row
+
+    carried = np.full(n, -1, dtype=np.int64)
+    kept = np.flatnonzero(old_to_new >= 0)
+    carried[old_to_new[kept]] = kept
+
+    fresh = np.flatnonzero(carried < 0)
+    if len(fresh) > REBUILD_FRACTION * n:
+        return build_graph(embeddings, manifest, k, index), n
+
+    # Carry lists over, re-pointed at the new row numbers
+    neighbors = np.full((n, k), -1, dtype=np.int32)
+    scores = np.full((n, k), -np.inf, dtype=np.float32)
+    clean = np.flatnonzero(carried >= 0)
+    old_nbrs = graph.neighbors[carried[clean]]
+    mapped = np.where(old_nbrs >= 0, old_to_new[np.maximum(old_nbrs, 0)], -1)
+    neighbors[clean] = mapped
+    scores[clean] = graph.scores[carried[clean]]
+
+    # A neighbor that was deleted or re-worded leaves a hole: search again
+    holes = ((old_nbrs >= 0) & (mapped < 0)).any(axis=1)
+    search_rows = np.concatenate([fresh, clean[holes]])
+    clean = clean[~holes]
+
+    if len(fresh) and len(clean):
+        merge_candidates(neighbors, scores, clean, embeddings, fresh)
+
+    if len(search_rows):
+        index = index or ann_index.ExactIndex(embeddings)
+        neighbors[search_rows], scores[search_rows] = search_neighbors(index, embeddings, search_rows, k)
+
+    return KNNGraph(neighbors, scores, case_ids, hashes, manifest["version"]), len(search_rows)
+
+
+def load_graph(path=KNN_PATH):
+    """
+    Saved graph, or None when it hasn't been built yet.
+    """
+    if not Path(path).exists():
+        return None
+    return KNNGraph.load(path)
+
+
+def main():
+    embeddings, manifest = embedding_store.load_store()
+    index = ann_index.load_index(embeddings=embeddings, manifest=manifest)
+
+    start = time.perf_counter()
+    graph = load_graph()
+    if graph is None:
+        print(f"Building {KNN_K}-NN graph over {len(embeddings):,} records ({index.kind} search)...")
+        graph, searched = build_graph(embeddings, manifest, KNN_K, index), len(embeddings)
+    elif graph.version == manifest["version"] and graph.k == KNN_K:
+        print("kNN graph up to date.")
+        return
+    else:
+        print(f"Updating {KNN_K}-NN graph ({index.kind} search)...")
+        graph, searched = update_graph(graph, embeddings, manifest, KNN_K, index)
+
+    graph.save()
+    print(f"✅ kNN graph: {len(graph.case_ids):,} records, {searched:,} searched "
+          f"in {time.perf_counter() - start:.1f}s")
+    print(f"Saved to: {KNN_PATH}")
+
+
+if __name__ == "__main__":
+    main()
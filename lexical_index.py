@@ -0,0 +1,115 @@
+# lexical_index.py
+"""
+BM25 inverted index over defect text for hybrid (lexical + semantic) search.
+
+Part numbers, serial-like codes and exact failure terms ("fastener hole
+elongation") are matched by term overlap, which embeddings blur. The index
+keeps one sparse column per term with the BM25 document weight (idf already
+folded in), so scoring a query is a sum over the columns of its terms and
+touches only the documents that contain them.
+
+In hybrid search the BM25 top-N rows are the candidate shortlist: dense
+similarity is computed only for those rows and the two scores are fused.
+"""
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+
+LEXICAL_FIELDS = ["defect_observed", "root_cause", "part_no"]
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Fused score = HYBRID_ALPHA * dense + (1 - HYBRID_ALPHA) * normalized BM25
+HYBRID_ALPHA = float(os.environ.get("HYBRID_ALPHA", 0.7))
+# Rows kept from the lexical side for dense re-scoring
+HYBRID_SHORTLIST = int(os.environ.get("HYBRID_SHORTLIST", 200))
+# Candidates within this fraction of the best BM25 score are kept even when
+# their cosine similarity is below MIN_SIMILARITY (e.g. an exact part number)
+HYBRID_LEXICAL_MATCH = float(os.environ.get("HYBRID_LEXICAL_MATCH", 0.8))
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+
+
+def tokenize(text):
+    """
+    Lowercase word tokens; hyphenated codes (part numbers like ST-2025-O4)
+    are kept whole and also split into their parts.
+    """
+    tokens = []
+    for tok in TOKEN_RE.findall(str(text).lower()):
+        tokens.append(tok)
+        if "-" in tok:
+            tokens.extend(tok.split("-"))
+    return tokens
+
+
+def lexical_text(df, fields=LEXICAL_FIELDS):
+    text = None
+    for f in (f for f in fields if f in df.columns):
+        col = df[f].fillna("").astype(str)
+        text = col if text is None else text + " " + col
+    return text if text is not None else pd.Series("", index=df.index)
+
+
+class BM25Index:
+    def __init__(self, texts, k1=BM25_K1, b=BM25_B):
+        self.vectorizer = CountVectorizer(analyzer=tokenize, dtype=np.float32)
+        tf = self.vectorizer.fit_transform(texts).tocsr()
+
+        n = tf.shape[0]
+        doc_len = np.asarray(tf.sum(axis=1)).ravel()
+        avg_len = doc_len.mean() if n else 0.0
+        df_counts = np.bincount(tf.indices, minlength=tf.shape[1])
+        self.idf = np.log1p((n - df_counts + 0.5) / (df_counts + 0.5)).astype(np.float32)
+
+        # BM25 term weight per (document, term), idf included
+        norm = k1 * (1 - b + b * doc_len / max(avg_len, 1e-9))
+        row_norm = np.repeat(norm, np.diff(tf.indptr))
+        tf.data = self.idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + row_norm)
+
+        # Column-major so each query term is one contiguous posting list
+        self.weights = tf.tocsc()
+        self.n = n
+
+    @classmethod
+    def from_df(cls, df, fields=LEXICAL_FIELDS):
+        return cls(lexical_text(df, fields))
+
+    def query_terms(self, query):
+        vocab = self.vectorizer.vocabulary_
+        return [vocab[t] for t in tokenize(query) if t in vocab]
+
+    def score(self, query):
+        """
+        BM25 score of every document for the query (0 where no term matches).
+        """
+        terms = self.query_terms(query)
+        if not terms:
+            return np.zeros(self.n, dtype=np.float32)
+        # Repeated query terms count once per occurrence
+        terms, counts = np.unique(terms, return_counts=True)
+        return np.asarray(self.weights[:, terms] @ counts.astype(np.float32)).ravel()
+
+    def shortlist(self, query, n=HYBRID_SHORTLIST, rows=None):
+        """
+        Top-n matching rows by BM25 (optionally within rows), as
+        (rows, scores), best first.
+        """
+        scores = self.score(query)
+        if rows is not None:
+            candidates = rows[scores[rows] > 0]
+        else:
+            candidates = np.flatnonzero(scores > 0)
+
+        cand_scores = scores[candidates]
+        if len(candidates) > n:
+            top = np.argpartition(-cand_scores, n - 1)[:n]
+            candidates, cand_scores = candidates[top], cand_scores[top]
+
+        order = np.lexsort((candidates, -cand_scores))
+        return candidates[order], cand_scores[order]
@@ -0,0 +1,139 @@
+# near_duplicates.py
+"""
+D2d: Near-Duplicate / Recurring Defect Detection
+
+Similarity join over the whole embedding store: every pair of records with
+cosine similarity >= DUP_THRESHOLD.
+
+The n x n similarity matrix is never materialized. Rows are split into
+blocks of DUP_BLOCK; a job scores one row block against itself and every
+later block (upper triangle only, so each pair is scored once) and keeps
+just the pairs above the threshold. Jobs run in parallel, each opening the
+store's memory map itself, so peak memory is about
+n_jobs * DUP_BLOCK^2 floats plus the surviving pairs.
+
+Pairs are linked into clusters (connected components): every case_id in a
+cluster is a near-duplicate of at least one other member.
+"""
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from joblib import Parallel, delayed
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+import embedding_store
+
+PAIRS_PATH = Path("data/analytics/near_duplicate_pairs.csv")
+CLUSTERS_PATH = Path("data/analytics/near_duplicate_clusters.csv")
+
+DUP_THRESHOLD = float(os.environ.get("DUP_THRESHOLD", 0.92))
+DUP_BLOCK = int(os.environ.get("DUP_BLOCK", 4096))      # 4096^2 float32 = 64 MB per job
+DUP_N_JOBS = int(os.environ.get("DUP_N_JOBS", -1))
+
+
+def block_pairs(matrix_path, start, block, threshold):
+    """
+    Pairs (i, j, score) with i in [start, start + block), j > i and
+    score >= threshold.
+    """
+    embeddings = np.load(matrix_path, mmap_mode="r")
+    n = len(embeddings)
+    rows = np.asarray(embeddings[start:start + block])
+
+    found_i, found_j, found_s = [], [], []
+    for col_start in range(start, n, block):
+        cols = rows if col_start == start else np.asarray(embeddings[col_start:col_start + block])
+        scores = rows @ cols.T
+
+        i, j = np.nonzero(scores >= threshold)
+        if col_start == start:
+            # Diagonal block: only pairs above the diagonal
+            upper = j > i
+            i, j = i[upper], j[upper]
+        found_i.append((i + start).astype(np.int32))
+        found_j.append((j + col_start).astype(np.int32))
+        found_s.append(scores[i, j].astype(np.float32))
+
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_s)
+
+
+def find_pairs(matrix_path=embedding_store.EMB_MATRIX_PATH, threshold=DUP_THRESHOLD,
+               block=DUP_BLOCK, n_jobs=DUP_N_JOBS):
+    """
+    All-pairs similarity join. Returns (i, j, score) arrays with i < j.
+    """
+    n = len(np.load(matrix_path, mmap_mode="r"))
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(block_pairs)(matrix_path, start, block, threshold)
+        for start in range(0, n, block)
+    )
+    if not results:
+        empty = np.empty(0, dtype=np.int32)
+        return empty, empty, np.empty(0, dtype=np.float32)
+    return tuple(np.concatenate([r[k] for r in results]) for k in range(3))
+
+
+def cluster_pairs(n, i, j):
+    """
+    Connected components of the pair graph. Returns a label per row, -1 for
+    rows without any near-duplicate.
+    """
+    graph = coo_matrix((np.ones(len(i), dtype=np.int8), (i, j)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+
+    sizes = np.bincount(labels)
+    labels = np.where(sizes[labels] > 1, labels, -1)
+
+    # Renumber clusters 0..k-1, largest first
+    clustered = labels[labels >= 0]
+    if not len(clustered):
+        return labels
+    ids, counts = np.unique(clustered, return_counts=True)
+    order = ids[np.lexsort((ids, -counts))]
+    remap = np.full(labels.max() + 1, -1)
+    remap[order] = np.arange(len(order))
+    return np.where(labels >= 0, remap[np.maximum(labels, 0)], -1)
+
+
+def main():
+    manifest = embedding_store.load_manifest()
+    case_ids = np.asarray(manifest["case_ids"])
+    n = len(case_ids)
+
+    print(f"Scanning {n:,} records for pairs with similarity ≥ {DUP_THRESHOLD} "
+          f"(blocks of {DUP_BLOCK:,})...")
+    start = time.perf_counter()
+    i, j, scores = find_pairs()
+    print(f"✅ Found {len(i):,} near-duplicate pairs in {time.perf_counter() - start:.1f}s")
+
+    order = np.argsort(-scores, kind="stable")
+    pairs = pd.DataFrame({
+        "case_id_a": case_ids[i[order]],
+        "case_id_b": case_ids[j[order]],
+        "similarity": np.round(scores[order], 4),
+    })
+    pairs.to_csv(PAIRS_PATH, index=False)
+
+    labels = cluster_pairs(n, i, j)
+    member = labels >= 0
+    clusters = pd.DataFrame({"cluster_id": labels[member], "case_id": case_ids[member]})
+    clusters["cluster_size"] = clusters.groupby("cluster_id")["case_id"].transform("size")
+    clusters = clusters.sort_values(["cluster_id", "case_id"])
+    clusters.to_csv(CLUSTERS_PATH, index=False)
+
+    print(f"✅ {clusters['cluster_id'].nunique():,} clusters covering {len(clusters):,} records")
+    for cid, members in clusters.groupby("cluster_id")["case_id"].apply(list).head(5).items():
+        shown = ", ".join(members[:5]) + (" ..." if len(members) > 5 else "")
+        print(f"  Cluster {cid} ({len(members)} records): {shown}")
+
+    print(f"Pairs saved to: {PAIRS_PATH}")
+    print(f"Clusters saved to: {CLUSTERS_PATH}")
+
+
+if __name__ == "__main__":
+    main()
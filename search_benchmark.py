@@ -0,0 +1,218 @@
+# search_benchmark.py
+"""
+D2f: Similarity Search Benchmark
+
+Scales the embedding store synthetically (BENCH_SIZES rows, default 1k to
+1M) and measures every search backend on it:
+- build time and on-disk index size
+- memory: in-memory size of the data scanned per query (where meaningful),
+  traced allocation peaks while building and while searching a batch,
+  and the process RSS growth across the backend's run
+- single-query latency p50 / p99 and batched throughput (queries/sec)
+- recall@k against exact brute-force search
+
+Synthetic rows are real store vectors (or random cluster centres when no
+store exists) plus noise, re-normalized, so neighbourhoods look like real
+data rather than uniform noise. Queries are held-out perturbed vectors.
+
+Only the search layer is timed (no query encoding), which is the part
+that grows with the corpus. Results go to BENCH_REPORT_PATH (CSV) and a
+JSON copy next to it, one row per (size, backend), so runs can be diffed
+for regressions.
+
+Run: python search_benchmark.py
+"""
+
+import json
+import os
+import shutil
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import ann_index
+import embedding_store
+
+BENCH_DIR = Path("data/analytics/bench")
+BENCH_REPORT_PATH = Path("data/analytics/search_benchmark.csv")
+
+BENCH_SIZES = [int(s) for s in os.environ.get("BENCH_SIZES", "1000,10000,100000,1000000").split(",")]
+BENCH_BACKENDS = os.environ.get("BENCH_BACKENDS", "exact,ivf,hnsw,int8,fp16,sharded").split(",")
+BENCH_QUERIES = int(os.environ.get("BENCH_QUERIES", 200))
+BENCH_K = int(os.environ.get("BENCH_K", 10))
+BENCH_NOISE = 0.35
+GEN_BLOCK = 65_536
+
+
+def base_vectors(dim=384, n_centres=2000, seed=0):
+    """
+    Seeds for synthetic rows: the real store if there is one.
+    """
+    if embedding_store.store_exists():
+        return np.asarray(embedding_store.load_embeddings(), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    return embedding_store.normalize(rng.normal(size=(n_centres, dim)))
+
+
+def synthetic_vectors(base, n, rng):
+    seeds = base[rng.integers(0, len(base), size=n)]
+    noise = rng.normal(scale=BENCH_NOISE / np.sqrt(base.shape[1]), size=seeds.shape)
+    return embedding_store.normalize(seeds + noise)
+
+
+def write_synthetic_store(n, base, bench_dir, seed=0):
+    """
+    n-row store (matrix + manifest) under bench_dir, written in blocks so
+    1M+ rows never sit in memory twice. Case ids spread over five years so
+    year sharding has something to split.
+    """
+    rng = np.random.default_rng(seed)
+    dim = base.shape[1]
+    matrix_path = bench_dir / "defect_embeddings.npy"
+    manifest_path = bench_dir / "defect_embeddings.json"
+
+    out = np.lib.format.open_memmap(matrix_path, mode="w+", dtype=np.float32, shape=(n, dim))
+    for start in range(0, n, GEN_BLOCK):
+        stop = min(start + GEN_BLOCK, n)
+        out[start:stop] = synthetic_vectors(base, stop - start, rng)
+    out.flush()
+    del out
+
+    case_ids = [f"DR_{2020 + i % 5}_{i:07d}" for i in range(n)]
+    hashes = [f"{i:016x}" for i in range(n)]
+    embedding_store._write_manifest(case_ids, hashes, "synthetic",
+                                    np.load(matrix_path, mmap_mode="r"), manifest_path)
+    return embedding_store.load_store(matrix_path, manifest_path)
+
+
+def dir_bytes(path):
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+
+def rss_bytes():
+    """
+    Current resident set size (Linux /proc), or None where unavailable.
+    Counts memory-mapped pages the backend touched and native allocations
+    (hnswlib) that tracemalloc cannot see.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def traced_peak(fn):
+    """
+    Run fn under tracemalloc; returns (result, peak bytes allocated).
+    numpy reports its buffers to tracemalloc, so this covers the matrices.
+    """
+    tracemalloc.start()
+    try:
+        result = fn()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def recall_at_k(truth, found):
+    return float(np.mean([
+        len(set(t) & set(f[f >= 0])) / len(t) for t, f in zip(truth, found)
+    ]))
+
+
+def bench_backend(kind, embeddings, manifest, queries, truth, bench_dir, k=BENCH_K):
+    before = dir_bytes(bench_dir)
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    index, build_peak = traced_peak(
+        lambda: ann_index.build_index(kind, embeddings, manifest, index_dir=bench_dir)
+    )
+    build_seconds = time.perf_counter() - start
+    index_bytes = dir_bytes(bench_dir) - before
+
+    index.search(queries[:1], k)                          # warm-up (maps files, caches)
+    times = []
+    for q in queries:
+        t = time.perf_counter()
+        index.search(q, k)
+        times.append((time.perf_counter() - t) * 1000)
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+
+    # Untimed: tracing slows allocation-heavy code
+    _, search_peak = traced_peak(lambda: index.search(queries, k))
+    rss_after = rss_bytes()
+
+    scanned = ann_index.index_nbytes(index)
+    mb = lambda b: round(b / 2**20, 2) if b is not None else None
+    return {
+        "backend": kind,
+        "build_seconds": round(build_seconds, 3),
+        "index_disk_mb": mb(index_bytes),
+        "scanned_mb": mb(scanned),
+        "build_peak_mb": mb(build_peak),
+        "search_peak_mb": mb(search_peak),
+        "rss_delta_mb": mb(rss_after - rss_before) if rss_before is not None else None,
+        "p50_ms": round(float(np.percentile(times, 50)), 3),
+        "p99_ms": round(float(np.percentile(times, 99)), 3),
+        "single_qps": round(1000 / max(float(np.mean(times)), 1e-9), 1),
+        "batch_qps": round(len(queries) / max(batch_seconds, 1e-9), 1),
+        f"recall_at_{k}": round(recall_at_k(truth, found), 4),
+    }
+
+
+def run_benchmark(sizes=BENCH_SIZES, backends=BENCH_BACKENDS, n_queries=BENCH_QUERIES, k=BENCH_K):
+    base = base_vectors()
+    rng = np.random.default_rng(1)
+    queries = synthetic_vectors(base, n_queries, rng)
+    rows = []
+
+    for n in sizes:
+        bench_dir = BENCH_DIR / f"n{n}"
+        shutil.rmtree(bench_dir, ignore_errors=True)
+        bench_dir.mkdir(parents=True)
+
+        print(f"\n📦 {n:,} rows")
+        embeddings, manifest = write_synthetic_store(n, base, bench_dir)
+        _, truth = ann_index.ExactIndex(embeddings).search(queries, k)
+
+        for kind in backends:
+            if kind == "hnsw" and ann_index.hnswlib is None:
+                print("  ⚠️ hnsw skipped (hnswlib not installed)")
+                continue
+            result = {"rows": n, "dim": manifest["dim"], "k": k, **bench_backend(
+                kind, embeddings, manifest, queries, truth, bench_dir, k
+            )}
+            rows.append(result)
+            print(f"  {kind:<8} p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  "
+                  f"batch {result['batch_qps']:10,.0f} q/s  recall@{k} {result[f'recall_at_{k}']:.3f}  "
+                  f"build {result['build_seconds']:.1f}s  peak {result['build_peak_mb']:.0f}/"
+                  f"{result['search_peak_mb']:.0f} MB")
+
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    return pd.DataFrame(rows)
+
+
+def main():
+    print(f"Benchmarking {', '.join(BENCH_BACKENDS)} on {', '.join(f'{n:,}' for n in BENCH_SIZES)} rows "
+          f"({BENCH_QUERIES} queries, k={BENCH_K})")
+    report = run_benchmark()
+    report.insert(0, "run_at", datetime.now().isoformat(timespec="seconds"))
+
+    report.to_csv(BENCH_REPORT_PATH, index=False)
+    BENCH_REPORT_PATH.with_suffix(".json").write_text(
+        json.dumps(report.to_dict(orient="records"), indent=2), encoding="utf-8"
+    )
+    print(f"\nReport saved to: {BENCH_REPORT_PATH} (+ .json)")
+
+
+if __name__ == "__main__":
+    main()
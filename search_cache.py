@@ -0,0 +1,97 @@
+# search_cache.py
+"""
+Bounded LRU cache for similar-defect search.
+
+Stores, per normalized query text, the query embedding and the top-k result
+list. Entries are keyed by the embedding store version the cache is bound
+to; binding a new version (e.g. after embeddings are rebuilt) drops every
+entry so stale results are never served.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1024))
+
+
+def normalize_query(text):
+    # Case, surrounding punctuation and whitespace runs don't change the search
+    text = re.sub(r"\s+", " ", str(text)).strip().lower()
+    return text.strip(" .,;:!?'\"")
+
+
+class SearchCache:
+    def __init__(self, max_entries=SEARCH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.version = None
+        self._embeddings = OrderedDict()
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {"embedding": 0, "results": 0}
+        self.misses = {"embedding": 0, "results": 0}
+
+    def bind(self, version):
+        """
+        Attach the cache to an embedding store version; a different version
+        invalidates everything cached so far.
+        """
+        with self._lock:
+            if version != self.version:
+                self._embeddings.clear()
+                self._results.clear()
+                self.version = version
+
+    def invalidate(self):
+        with self._lock:
+            self._embeddings.clear()
+            self._results.clear()
+
+    def _get(self, store, kind, key):
+        with self._lock:
+            key = (self.version, key)
+            if key in store:
+                store.move_to_end(key)
+                self.hits[kind] += 1
+                return store[key]
+            self.misses[kind] += 1
+            return None
+
+    def _put(self, store, key, value):
+        with self._lock:
+            store[(self.version, key)] = value
+            store.move_to_end((self.version, key))
+            while len(store) > self.max_entries:
+                store.popitem(last=False)
+
+    def get_embedding(self, query):
+        return self._get(self._embeddings, "embedding", normalize_query(query))
+
+    def put_embedding(self, query, embedding):
+        self._put(self._embeddings, normalize_query(query), embedding)
+
+    def get_results(self, query, params=()):
+        """
+        params: hashable tuple of everything else that shapes the result
+        (top_k, index kind, filters, ...).
+        """
+        results = self._get(self._results, "results", (normalize_query(query), params))
+        return list(results) if results is not None else None
+
+    def put_results(self, query, results, params=()):
+        self._put(self._results, (normalize_query(query), params), list(results))
+
+    def stats(self):
+        with self._lock:
+            out = {"version": self.version, "entries": len(self._results)}
+            for kind in ("embedding", "results"):
+                total = self.hits[kind] + self.misses[kind]
+                out[f"{kind}_hits"] = self.hits[kind]
+                out[f"{kind}_misses"] = self.misses[kind]
+                out[f"{kind}_hit_rate"] = round(self.hits[kind] / total, 3) if total else 0.0
+            return out
+
+
+# Process-wide cache shared by the CLI, dashboard and search service
+QUERY_CACHE = SearchCache()
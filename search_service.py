@@ -0,0 +1,325 @@
+# search_service.py
+"""
+D2c: Local Similar Defect Search Service
+
+Standalone asyncio HTTP service that loads the query encoder, embedding
+store, index and filters once and serves every client from them.
+
+Concurrent requests are queued and coalesced into micro-batches: the batch
+worker takes the first waiting request, keeps collecting for up to
+BATCH_MAX_WAIT_MS (or BATCH_MAX_SIZE requests), then answers the whole batch
+with one encode call and one scoring pass (find_similar_batch).
+
+Endpoints (JSON):
+  POST /similar  {"query": "...", "top_k": 5, "filters": {...}, "hybrid": false}
+  POST /insight  same body; returns the results plus generate_ai_insight
+  GET  /metrics  queue depth, batch sizes, latency percentiles, cache stats
+  GET  /health
+
+Run: python search_service.py  (SERVICE_HOST / SERVICE_PORT to change the
+address; binds to localhost by default)
+"""
+
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ann_index
+import embedding_store
+import encoder
+from ai_similarity_search import (
+    load_data,
+    refresh_embeddings,
+    find_similar_batch,
+    generate_ai_insight,
+    MODEL_NAME,
+    SEARCH_MODE,
+)
+from facet_index import FacetIndex, filters_key
+from insight_table import load_insights
+from lexical_index import BM25Index
+from search_cache import QUERY_CACHE
+
+SERVICE_HOST = os.environ.get("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("SERVICE_PORT", 8765))
+
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 32))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 10))
+
+MAX_TOP_K = 50
+MAX_BODY_BYTES = 1 << 20
+LATENCY_WINDOW = 2048
+
+
+class SearchState:
+    """
+    Everything loaded once at startup and shared by all requests.
+    """
+
+    def __init__(self):
+        self.df = load_data()
+        self.model = encoder.load_encoder(MODEL_NAME)
+        # Corpus vectors always come from the reference model
+        reference = self.model if encoder.ENCODER_BACKEND == "torch" else None
+        self.embeddings, _ = refresh_embeddings(self.df, reference)
+
+        manifest = embedding_store.load_manifest()
+        self.version = manifest["version"]
+        self.index = ann_index.load_index(embeddings=self.embeddings, manifest=manifest)
+        self.facets = FacetIndex(self.df)
+        self.lexical = BM25Index.from_df(self.df)
+        self.insights = load_insights(self.df)
+        QUERY_CACHE.bind(self.version)
+
+    def search(self, queries, top_k, filters, hybrid):
+        return find_similar_batch(
+            queries, self.df, self.embeddings, self.model, top_k,
+            index=self.index, cache=QUERY_CACHE,
+            filters=filters, facets=self.facets,
+            lexical=self.lexical if hybrid else None,
+        )
+
+
+class Metrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.max_batch = 0
+        self.latency_ms = deque(maxlen=LATENCY_WINDOW)      # enqueue -> response
+        self.search_ms = deque(maxlen=LATENCY_WINDOW)       # one batch's encode + scoring
+        self.started = time.time()
+
+    def record_batch(self, size, seconds):
+        self.batches += 1
+        self.batched_queries += size
+        self.max_batch = max(self.max_batch, size)
+        self.search_ms.append(seconds * 1000)
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return {"p50": None, "p99": None}
+        arr = np.asarray(values)
+        return {
+            "p50": round(float(np.percentile(arr, 50)), 2),
+            "p99": round(float(np.percentile(arr, 99)), 2),
+        }
+
+    def snapshot(self, queue_depth):
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "queue_depth": queue_depth,
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": round(self.batched_queries / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "latency_ms": self._percentiles(self.latency_ms),
+            "batch_search_ms": self._percentiles(self.search_ms),
+            "cache": QUERY_CACHE.stats(),
+        }
+
+
+class MicroBatcher:
+    def __init__(self, state, metrics, max_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.state = state
+        self.metrics = metrics
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # Encoding and scoring block, so they run off the event loop, one batch at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, query, top_k=5, filters=None, hybrid=False):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, filters, hybrid, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_batch(self, batch):
+        # Requests with the same search parameters share one find_similar_batch call
+        groups = defaultdict(list)
+        for i, (_, top_k, filters, hybrid, _) in enumerate(batch):
+            groups[(top_k, filters_key(filters), hybrid)].append(i)
+
+        # A failing group (e.g. an unknown filter) only fails its own requests
+        results = [None] * len(batch)
+        for members in groups.values():
+            _, top_k, filters, hybrid, _ = batch[members[0]]
+            try:
+                found = self.state.search([batch[i][0] for i in members], top_k, filters, hybrid)
+            except Exception as e:
+                found = [e] * len(members)
+            for i, res in zip(members, found):
+                results[i] = res
+        return results
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self._run_batch, batch)
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.record_batch(len(batch), time.perf_counter() - start)
+            for (*_, future), res in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(res, Exception):
+                    future.set_exception(res)
+                else:
+                    future.set_result(res)
+
+
+def _json_safe(value):
+    # Missing CSV fields come through as NaN, which is not valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_json_safe(v) for v in value]
+    return value
+
+
+class SearchService:
+    def __init__(self, state):
+        self.state = state
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(state, self.metrics)
+
+    def _parse_search(self, body):
+        query = str(body.get("query", "")).strip()
+        if not query:
+            raise ValueError("'query' is required")
+        try:
+            top_k = int(body.get("top_k", 5))
+        except (TypeError, ValueError, OverflowError):
+            # null, lists, objects, "abc", Infinity: a bad request, not a server error
+            raise ValueError("'top_k' must be an integer") from None
+        if not 1 <= top_k <= MAX_TOP_K:
+            raise ValueError(f"'top_k' must be between 1 and {MAX_TOP_K}")
+        filters = body.get("filters") or None
+        if filters is not None and not isinstance(filters, dict):
+            raise ValueError("'filters' must be an object")
+        hybrid = bool(body.get("hybrid", SEARCH_MODE == "hybrid"))
+        return query, top_k, filters, hybrid
+
+    async def handle(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "store_version": self.state.version,
+                         "index": self.state.index.kind, "records": len(self.state.df)}
+
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics.snapshot(self.batcher.queue.qsize())
+
+        if method == "POST" and path in ("/similar", "/insight"):
+            query, top_k, filters, hybrid = self._parse_search(body)
+            results = await self.batcher.submit(query, top_k, filters, hybrid)
+            if path == "/similar":
+                return 200, {"query": query, "results": results}
+            return 200, {"query": query, "results": results,
+                         "insight": generate_ai_insight(results, self.state.insights)}
+
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def serve_client(self, reader, writer):
+        start = time.perf_counter()
+        status, payload = 500, {"error": "internal error"}
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) < 2:
+                raise ValueError("malformed request line")
+            method, path = request_line[0].upper(), request_line[1].split("?", 1)[0]
+
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                raise ValueError("request body too large")
+            raw = await reader.readexactly(length) if length else b""
+            body = json.loads(raw) if raw else {}
+            if not isinstance(body, dict):
+                raise ValueError("request body must be a JSON object")
+
+            self.metrics.requests += 1
+            status, payload = await self.handle(method, path, body)
+        except (ValueError, json.JSONDecodeError) as e:
+            status, payload = 400, {"error": str(e)}
+        except Exception as e:
+            print(f"❌ Request failed: {e!r}")
+        finally:
+            if status >= 400:
+                self.metrics.errors += 1
+            self.metrics.latency_ms.append((time.perf_counter() - start) * 1000)
+
+            data = json.dumps(_json_safe(payload)).encode("utf-8")
+            reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Internal Server Error")
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + data
+            )
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+
+async def serve(host=SERVICE_HOST, port=SERVICE_PORT, state=None):
+    print("Loading search components...")
+    service = SearchService(state or SearchState())
+
+    batch_task = asyncio.create_task(service.batcher.run())
+    server = await asyncio.start_server(service.serve_client, host, port)
+
+    print(f"✅ Search service ready on http://{host}:{port} "
+          f"(batch ≤{BATCH_MAX_SIZE}, wait ≤{BATCH_MAX_WAIT_MS:g} ms)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main():
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nSearch service stopped.")
+
+
+if __name__ == "__main__":
+    main()
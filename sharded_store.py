@@ -0,0 +1,234 @@
+# sharded_store.py
+"""
+Sharded layout of the embedding store for search (SEARCH_INDEX=sharded).
+
+The store is split into shards, by year of occurrence (date_of_occurrence,
+the field date filters use) or into fixed-size row ranges, each its own
+.npy under SHARD_DIR with the global row numbers it holds. A query fans out to the shards on a thread
+pool (matrix products release the GIL), each shard returns its own top-k,
+and the per-shard lists are merged into the global top-k.
+
+Shards are memory-mapped lazily on first use, so a year nobody searches
+costs no memory. With a row filter (facet_index), shards holding none of
+the rows are skipped without being mapped at all, so a date filter only
+maps the years it covers.
+
+Shards are rebuilt from the store by python sharded_store.py (or
+ann_index.build_index("sharded")). Only shards whose records changed are
+rewritten (a model change rewrites all of them); closed years are
+written once.
+"""
+
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import ann_index
+import embedding_store
+
+DATA_PATH = Path("data/analytics/defect_reports_with_clusters.csv")
+SHARD_DIR = embedding_store.EMB_MATRIX_PATH.parent / "embedding_shards"
+SHARD_META = "shards.json"
+
+SHARD_BY = os.environ.get("SHARD_BY", "year")                 # year | size
+SHARD_SIZE = int(os.environ.get("SHARD_SIZE", 250_000))       # rows per shard when SHARD_BY=size
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", min(8, os.cpu_count() or 1)))
+
+YEAR_RE = re.compile(r"^DR_(\d{4})_")
+
+
+def shard_key(case_id):
+    # Report year from the case_id; only used for records without a date
+    m = YEAR_RE.match(str(case_id))
+    return m.group(1) if m else "other"
+
+
+def occurrence_years(case_ids, data_path=DATA_PATH):
+    """
+    Year of occurrence per case_id (the year date filters see), falling
+    back to the case_id year for records the data file doesn't date.
+    """
+    years = {}
+    if Path(data_path).exists():
+        df = pd.read_csv(data_path, usecols=["case_id", "date_of_occurrence"])
+        dates = pd.to_datetime(df["date_of_occurrence"], dayfirst=True, errors="coerce")
+        dated = dates.notna()
+        years = dict(zip(df.loc[dated, "case_id"].astype(str), dates[dated].dt.year.astype(str)))
+    return [years.get(str(c)) or shard_key(c) for c in case_ids]
+
+
+def partition(case_ids, by=SHARD_BY, size=SHARD_SIZE, years=None):
+    """
+    Shard key -> sorted global row numbers.
+    """
+    if by == "size":
+        return OrderedDict(
+            (f"part{i:04d}", np.arange(start, min(start + size, len(case_ids))))
+            for i, start in enumerate(range(0, len(case_ids), size))
+        )
+    if by != "year":
+        raise ValueError(f"Unknown SHARD_BY '{by}' (choose year or size)")
+
+    keys = np.asarray(years if years is not None else occurrence_years(case_ids))
+    return OrderedDict((key, np.flatnonzero(keys == key)) for key in sorted(set(keys)))
+
+
+def shard_digest(case_ids, text_hashes, model_name, dim):
+    # The vectors depend on the model as well as the texts
+    digest = hashlib.sha1(f"{model_name}:{dim};".encode("utf-8"))
+    for cid, h in zip(case_ids, text_hashes):
+        digest.update(f"{cid}:{h};".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def load_meta(shard_dir=SHARD_DIR):
+    path = Path(shard_dir) / SHARD_META
+    if not path.exists():
+        raise FileNotFoundError(f"Shard manifest not found: {path}")
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def build_shards(embeddings, manifest, shard_dir=SHARD_DIR, by=SHARD_BY, size=SHARD_SIZE,
+                 years=None):
+    """
+    Write (or refresh) the shards for the current store. years gives each
+    row's shard key for SHARD_BY=year (default: occurrence_years). Returns
+    the number of shard matrices rewritten.
+    """
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        old_meta = load_meta(shard_dir)
+    except FileNotFoundError:
+        old_meta = {"by": None, "shards": []}
+    old_keys = {s["key"] for s in old_meta["shards"]}
+    old = {s["key"]: s for s in old_meta["shards"]} if old_meta["by"] == by else {}
+
+    case_ids, hashes = manifest["case_ids"], manifest["text_hashes"]
+    shards, written = [], 0
+
+    for key, rows in partition(case_ids, by, size, years).items():
+        digest = shard_digest([case_ids[r] for r in rows], [hashes[r] for r in rows],
+                              manifest["model_name"], manifest["dim"])
+        matrix_file = f"shard_{key}.npy"
+
+        # Unchanged records -> keep the matrix; row numbers may still have moved
+        if old.get(key, {}).get("digest") != digest or not (shard_dir / matrix_file).exists():
+            embedding_store._atomic_write(
+                shard_dir / matrix_file,
+                lambda f, rows=rows: np.save(f, np.asarray(embeddings[rows], dtype=np.float32)),
+            )
+            written += 1
+        embedding_store._atomic_write(
+            shard_dir / f"shard_{key}.rows.npy",
+            lambda f, rows=rows: np.save(f, rows.astype(np.int64)),
+        )
+
+        shards.append({"key": key, "digest": digest, "count": int(len(rows))})
+
+    for key in old_keys - {s["key"] for s in shards}:
+        for suffix in (".npy", ".rows.npy"):
+            (shard_dir / f"shard_{key}{suffix}").unlink(missing_ok=True)
+
+    meta = {"version": manifest["version"], "by": by, "dim": manifest["dim"], "shards": shards}
+    embedding_store._atomic_write(
+        shard_dir / SHARD_META, lambda f: f.write(json.dumps(meta, indent=2).encode("utf-8"))
+    )
+    return written
+
+
+class Shard:
+    def __init__(self, key, shard_dir):
+        self.key = key
+        self.path = Path(shard_dir) / f"shard_{key}.npy"
+        self.rows = np.load(Path(shard_dir) / f"shard_{key}.rows.npy")      # sorted global rows
+        self._embeddings = None
+
+    @property
+    def embeddings(self):
+        # Mapped on first search that needs this shard
+        if self._embeddings is None:
+            self._embeddings = np.load(self.path, mmap_mode="r")
+        return self._embeddings
+
+    @property
+    def mapped(self):
+        return self._embeddings is not None
+
+    def local_rows(self, rows):
+        """
+        Positions in this shard of the given (sorted) global rows.
+        """
+        pos = np.searchsorted(self.rows, rows)
+        pos = pos[pos < len(self.rows)]
+        return pos[np.isin(self.rows[pos], rows, assume_unique=True)]
+
+    def search(self, queries, k, local=None):
+        scores, ids = ann_index.ExactIndex(self.embeddings).search(queries, k, rows=local)
+        return scores, self.rows[ids]
+
+
+class ShardedIndex:
+    kind = "sharded"
+    supports_rows = True
+
+    def __init__(self, shards, version, workers=SHARD_WORKERS):
+        self.shards = shards
+        self.version = version
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    @classmethod
+    def load(cls, shard_dir=SHARD_DIR, workers=SHARD_WORKERS):
+        meta = load_meta(shard_dir)
+        shards = [Shard(s["key"], shard_dir) for s in meta["shards"]]
+        return cls(shards, meta["version"], workers)
+
+    def search(self, queries, k, rows=None):
+        queries = np.atleast_2d(queries).astype(np.float32)
+
+        tasks = []
+        for shard in self.shards:
+            local = None
+            if rows is not None:
+                local = shard.local_rows(rows)
+                if not len(local):
+                    continue        # nothing to score here: never mapped
+            tasks.append(self.pool.submit(shard.search, queries, k, local))
+
+        results = [t.result() for t in tasks]
+        if not results:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.float32), empty.astype(np.int64)
+
+        # Merge per-shard top-k lists into the global top-k; ties go to the
+        # lower global row, as in ExactIndex
+        all_scores = np.hstack([r[0] for r in results])
+        all_ids = np.hstack([r[1] for r in results])
+        top = np.lexsort((all_ids, -all_scores), axis=1)[:, :k]
+        return np.take_along_axis(all_scores, top, axis=1), np.take_along_axis(all_ids, top, axis=1)
+
+    def mapped_shards(self):
+        return [s.key for s in self.shards if s.mapped]
+
+
+def main():
+    embeddings, manifest = embedding_store.load_store()
+    written = build_shards(embeddings, manifest)
+    meta = load_meta()
+
+    print(f"✅ {len(meta['shards'])} shards by {meta['by']} ({written} rewritten):")
+    for s in meta["shards"]:
+        print(f"  {s['key']}: {s['count']:,} records")
+    print(f"Shards saved in: {SHARD_DIR}")
+
+
+if __name__ == "__main__":
+    main()